@@ -0,0 +1,313 @@
+#!/usr/bin/python3
+
+import pandas as pd
+import numpy as np
+from zipfile import ZipFile as zf, ZIP_DEFLATED
+from contextlib import redirect_stdout
+import argparse
+import gc
+import io
+import json
+import os
+import pathlib
+import platform
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+
+import merge_data as md
+
+# roughly today's HESA tables: providers, academic years (including the
+# 2015/16 that is dropped) and categories beyond the ones merge_data keeps
+BASE_PROVIDERS = 230
+BASE_YEARS = 7
+FILLER_CATEGORIES = 25
+LAST_YEAR = 2021
+
+# HESA's own preamble above every table's header
+PREAMBLE = [
+    'Title,"{title}"', 'Location,UK', 'Academic years,{years}', 'Data source,HESA',
+    'Data source link,https://www.hesa.ac.uk/data-and-analysis/finances',
+    'Data file canonical link,https://www.hesa.ac.uk/data-and-analysis/finances',
+    'Licence,Creative Commons Attribution 4.0 International Licence',
+    'Code page,"Unicode UTF-8 "', '', 'Last updated,Apr-23', '', '',
+]
+
+GROUP_LEVELS = {
+    'Provider region': ['East Midlands', 'London', 'North West', 'Scotland', 'Wales', 'South West'],
+    'Provider country': ['England', 'Scotland', 'Wales', 'Northern Ireland'],
+    'Russell Group filter': ['Member', 'Non-member'],
+    'Pre 92 filter': ['Member', 'Non-member'],
+    'Post 92 filter': ['Member', 'Non-member'],
+}
+
+def academic_years(n):
+    # the n years up to LAST_YEAR, as HESA labels them
+    return [f"{y}/{(y+1) % 100:02d}" for y in range(LAST_YEAR - n + 1, LAST_YEAR + 1)]
+
+def accounting_values(rng, n):
+    # £000s as HESA writes them: thousands separators, negatives in
+    # parentheses and the odd blank
+    text = pd.Series(rng.integers(0, 2_000_000, n)).map('{:,}'.format)
+    negative = rng.random(n) < 0.1
+    text[negative] = '(' + text[negative] + ')'
+    text[rng.random(n) < 0.05] = ''
+    return text.to_numpy()
+
+def product_frame(levels):
+    # every combination of the given column values, in order
+    return pd.MultiIndex.from_product(list(levels.values()), names=list(levels)).to_frame(index=False)
+
+def write_hesa_csv(csv_file, tbl, title, years):
+    preamble = '\n'.join(PREAMBLE).format(title=title, years=f"{years[0]} to {years[-1]}")
+    csv_file.write('﻿' + preamble + '\n')
+    tbl.to_csv(csv_file, index=False)
+
+def provider_rows(tbl, providers):
+    # UKPRN, name and location of each row's provider, where the sector
+    # totals are the rows without a UKPRN
+    ukprns = np.append(providers, -1)
+    ukprn = ukprns[tbl['provider']]
+    return pd.DataFrame({
+        'UKPRN': np.where(ukprn < 0, '', ukprn.astype('str')),
+        'HE provider': np.where(ukprn < 0, 'Total', 'Provider ' + ukprn.astype('str')),
+        'Country of HE provider': 'England',
+        'Region of HE provider': 'London',
+    })
+
+def generate_table(rng, tbl_id, providers, years):
+    # one table's rows in the column layout merge_data reads it with
+    categories = md.CATEGORIES[tbl_id] + [f"Other item {i}" for i in range(FILLER_CATEGORIES)]
+    levels = {'provider': range(len(providers) + 1), 'Academic year': years}
+    if tbl_id == 6:
+        levels = {'provider': levels['provider'], 'Source of fees': ['Total', 'UK', 'Non-UK'],
+            'Academic year': years}
+    elif tbl_id == 9:
+        levels['Type of asset'] = ['Total capital expenditure', 'Land and buildings']
+    levels['Year End Month'] = ['All', '07, July']
+    levels['Category'] = categories
+    tbl = product_frame(levels)
+
+    ids = provider_rows(tbl, providers)
+    meta = {'Financial year end': '', 'Year End Month': tbl['Year End Month']}
+    if tbl_id == 12:
+        columns = {'Category': tbl['Category'], 'Unit': '£000s', 'Value': None}
+    else:
+        columns = {'Category marker': 'Total', 'Category': tbl['Category'], 'Value(£000s)': None}
+    value_col = list(columns)[-1]
+    columns[value_col] = accounting_values(rng, len(tbl))
+
+    if tbl_id == 6:
+        ids.insert(4, 'Source of fees', tbl['Source of fees'])
+    ids['Academic year'] = tbl['Academic year']
+    if tbl_id == 9:
+        meta['Type of asset'] = tbl['Type of asset']
+    return pd.concat([ids, pd.DataFrame(meta), pd.DataFrame(columns)], axis=1)
+
+def generate_remuneration(rng, providers, year):
+    # one academic year of table 11, as a zip member
+    remuneration = md.CATEGORIES[11] + [f"Other remuneration {i}" for i in range(FILLER_CATEGORIES)]
+    tbl = product_frame({
+        'provider': range(len(providers) + 1),
+        'Head of provider marker': ['Head of provider at financial year end',
+            'Previous head of provider', 'Total'],
+        'Year End Month': ['All', '07, July'],
+        'Remuneration': remuneration,
+    })
+    ids = provider_rows(tbl, providers).rename(columns={'HE provider': 'HE Provider'})
+    return pd.concat([ids, pd.DataFrame({
+        'Academic Year': year,
+        'Financial year end': '',
+        'Head of provider marker': tbl['Head of provider marker'],
+        'Remuneration': tbl['Remuneration'],
+        'Unit': '(£000s)',
+        'Value': accounting_values(rng, len(tbl)),
+        'Year End Month': tbl['Year End Month'],
+    })], axis=1)
+
+def generate_data(data_dir, n_providers, n_years, seed=0):
+    # synthetic HESA-shaped inputs for merge_data, the same for the same seed
+    rng = np.random.default_rng(seed)
+    data_dir.mkdir(parents=True, exist_ok=True)
+    providers = 10000000 + np.arange(n_providers)
+    years = academic_years(n_years)
+
+    for tbl_id in [1, 3, 4, 6, 7, 9, 12]:
+        with open(data_dir.joinpath(f"table-{tbl_id}.csv"), 'w', newline='', encoding='utf-8') as csv_file:
+            write_hesa_csv(csv_file, generate_table(rng, tbl_id, providers, years),
+                f"Synthetic table {tbl_id}", years)
+
+    # table 11 comes as one member per year from 2016/17
+    with zf(data_dir.joinpath("table-11.zip"), 'w', ZIP_DEFLATED) as z:
+        for year in years:
+            if year <= '2015/16':
+                continue
+            csv_file = io.StringIO()
+            write_hesa_csv(csv_file, generate_remuneration(rng, providers, year),
+                "Synthetic table 11", [year])
+            z.writestr(f"table-11-({year.replace('/', '-')}).csv", csv_file.getvalue())
+
+    groups = {'Provider UKPRN': providers}
+    for col, levels in GROUP_LEVELS.items():
+        groups[col] = rng.choice(levels, n_providers)
+    pd.DataFrame(groups).to_csv(data_dir.joinpath("provider_groups.csv"), index=False)
+
+    return {f.name: f.stat().st_size for f in sorted(data_dir.iterdir())}
+
+def reset_peak_rss():
+    # resets VmHWM on Linux, elsewhere the peak only ever grows
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+    except OSError:
+        pass
+
+def peak_rss_mb():
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+def run_stage(stages, name, fn, *args, **kwargs):
+    # wall time and peak RSS of a single pipeline stage
+    gc.collect()
+    reset_peak_rss()
+    start = time.perf_counter()
+    with redirect_stdout(io.StringIO()):
+        out = fn(*args, **kwargs)
+    stages.append({'stage': name, 'seconds': time.perf_counter() - start,
+        'peak_rss_mb': peak_rss_mb()})
+    return out
+
+def run_pipeline(backend='pandas'):
+    # merge_data's main, stage by stage, on the ./data in the working directory
+    stages = []
+    parse = md.PARSERS[backend]
+    tbls = [run_stage(stages, f"parse_table {T}", parse, T) for T in [1,3,4,6,7,9,12]]
+    tbls.append(run_stage(stages, "parse_zip 11", md.parse_zip, 11, backend))
+    long_tbl = run_stage(stages, "concat", pd.concat, tbls, ignore_index=True)
+    wide = run_stage(stages, "pivot_wide", md.pivot_wide, long_tbl)
+    kfi = run_stage(stages, "key_financial_indicators", md.key_financial_indicators, wide)
+    kfi = kfi.round(3)
+    kfi = run_stage(stages, "join provider groups", lambda: kfi.join(md.provider_groups(), on='ukprn', how='inner'))
+    kfis = list(md.KFI_FORMULAS)
+    run_stage(stages, "quantile_cube", md.quantile_cube, kfi, kfis)
+    run_stage(stages, "peer_ranks", md.peer_ranks, kfi, kfis)
+    return stages
+
+def check_backends(backends):
+    # the wide table from every backend against the one from pandas, the reference
+    with redirect_stdout(io.StringIO()):
+        reference = md.pivot_wide(pd.concat(md.parse_tables(), ignore_index=True))
+        for backend in backends:
+            wide = md.pivot_wide(pd.concat(md.parse_tables(backend=backend), ignore_index=True))
+            try:
+                pd.testing.assert_frame_equal(wide, reference)
+            except AssertionError as err:
+                return f"{backend} differs from pandas: {err}"
+    return None
+
+def best_of(runs):
+    # the fastest time and largest peak of each stage over repeated runs
+    return [
+        {'stage': stages[0]['stage'],
+            'seconds': min(s['seconds'] for s in stages),
+            'peak_rss_mb': max(s['peak_rss_mb'] for s in stages)}
+        for stages in zip(*runs)
+    ]
+
+def git_commit():
+    # the commit being benchmarked, and whether the tree has changes on top
+    repo = pathlib.Path(__file__).resolve().parent
+    try:
+        commit = subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=repo,
+            capture_output=True, text=True, check=True).stdout.strip()
+        dirty = subprocess.run(['git', 'status', '--porcelain', '--untracked-files=no'], cwd=repo,
+            capture_output=True, text=True, check=True).stdout.strip() != ''
+    except (OSError, subprocess.CalledProcessError):
+        return None, None
+    return commit, dirty
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-p', '--provider-scale', type=float, nargs='+', default=[1],
+        help=f"Multiples of {BASE_PROVIDERS} providers to benchmark")
+    parser.add_argument('-y', '--year-scale', type=float, nargs='+', default=[1],
+        help=f"Multiples of {BASE_YEARS} academic years to benchmark")
+    parser.add_argument('-r', '--repeat', type=int, default=3,
+        help="Runs of the pipeline per scale, the fastest time of each stage is kept")
+    parser.add_argument('-s', '--seed', type=int, default=0,
+        help="Seed of the synthetic data generator")
+    parser.add_argument('-d', '--data-dir', type=pathlib.Path,
+        help="Where the synthetic data is kept between runs (a temporary directory by default)")
+    parser.add_argument('-b', '--backend', nargs='+', choices=list(md.PARSERS), default=['pandas'],
+        help="merge_data parsing backends to benchmark")
+    parser.add_argument('-c', '--check', action='store_true',
+        help="Check the wide table from each non-pandas backend matches the pandas one")
+    parser.add_argument('-o', '--output', type=pathlib.Path,
+        help="JSON file the results are written to")
+    args = parser.parse_args()
+
+    commit, dirty = git_commit()
+    results = {
+        'commit': commit, 'dirty': dirty, 'seed': args.seed, 'repeat': args.repeat,
+        'python': platform.python_version(), 'pandas': pd.__version__, 'numpy': np.__version__,
+        'machine': platform.machine(), 'cpus': os.cpu_count(), 'runs': [],
+    }
+
+    cwd = os.getcwd()
+    with tempfile.TemporaryDirectory() as tmp:
+        root = args.data_dir or pathlib.Path(tmp)
+        for p_scale in args.provider_scale:
+            for y_scale in args.year_scale:
+                n_providers = round(BASE_PROVIDERS * p_scale)
+                n_years = round(BASE_YEARS * y_scale)
+                # merge_data reads ./data, so each scale gets its own working directory
+                work = root.joinpath(f"providers-{n_providers}_years-{n_years}_seed-{args.seed}").resolve()
+                data_dir = work.joinpath('data')
+                if data_dir.exists():
+                    files = {f.name: f.stat().st_size for f in sorted(data_dir.iterdir())}
+                else:
+                    print(f"Generating {n_providers} providers over {n_years} years")
+                    files = generate_data(data_dir, n_providers, n_years, args.seed)
+
+                os.chdir(work)
+                try:
+                    others = [b for b in args.backend if b != 'pandas']
+                    mismatch = check_backends(others) if args.check and others else None
+                    backend_runs = {
+                        backend: best_of([run_pipeline(backend) for _ in range(args.repeat)])
+                        for backend in args.backend
+                    }
+                finally:
+                    os.chdir(cwd)
+
+                if mismatch:
+                    sys.exit(mismatch)
+                for backend, stages in backend_runs.items():
+                    print(f"\n{n_providers} providers, {n_years} years "
+                        f"({sum(files.values()) / 2**20:.1f} MiB), {backend} backend")
+                    print(f"{'stage':<30} {'seconds':>10} {'peak RSS (MiB)':>15}")
+                    for s in stages:
+                        print(f"{s['stage']:<30} {s['seconds']:>10.3f} {s['peak_rss_mb']:>15.1f}")
+                    print(f"{'total':<30} {sum(s['seconds'] for s in stages):>10.3f}")
+
+                    results['runs'].append({
+                        'provider_scale': p_scale, 'year_scale': y_scale,
+                        'providers': n_providers, 'years': n_years, 'backend': backend,
+                        'checked': args.check and backend != 'pandas',
+                        'input_bytes': files, 'stages': stages,
+                    })
+
+    if args.output:
+        args.output.write_text(json.dumps(results, indent=2))
+    return results
+
+if __name__ == "__main__":
+    main()
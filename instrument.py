@@ -0,0 +1,115 @@
+import contextlib
+import json
+import os
+import resource
+import time
+
+# spans recorded so far, or None when instrumentation is off. Everything below
+# checks this first, so a disabled span costs a single function call.
+SPANS = None
+
+# handed out for every span while instrumentation is off
+DISABLED = contextlib.nullcontext({})
+
+def enable():
+    global SPANS
+    SPANS = []
+
+def enabled():
+    return SPANS is not None
+
+def rss_mb():
+    # resident memory of this process right now
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') / 2**20
+    except (OSError, ValueError):
+        # no /proc: the peak is the closest thing available
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+@contextlib.contextmanager
+def record(name, attrs):
+    info = dict(attrs)
+    rss = rss_mb()
+    wall = time.time()
+    start = time.perf_counter()
+    try:
+        yield info
+    finally:
+        SPANS.append({
+            'name': name,
+            'start': wall,
+            'seconds': time.perf_counter() - start,
+            'rss_delta_mb': rss_mb() - rss,
+            'pid': os.getpid(),
+            **info,
+        })
+
+def span(name, **attrs):
+    # times the enclosed block, e.g.
+    #   with span('pivot', rows_in=len(long)) as s:
+    #       ...
+    #       s['rows_out'] = len(wide)
+    if SPANS is None:
+        return DISABLED
+    return record(name, attrs)
+
+def iterate(name, items, **attrs):
+    # a span per item, covering the time taken to produce it (e.g. the chunks
+    # of a CSV reader), with the item's length as its rows out
+    if SPANS is None:
+        return items
+    return recorded_items(name, items, attrs)
+
+def recorded_items(name, items, attrs):
+    items = iter(items)
+    while True:
+        with record(name, attrs) as info:
+            item = next(items, None)
+            info['rows_out'] = 0 if item is None else len(item)
+        if item is None:
+            return
+        yield item
+
+def collect(on, fn, *args):
+    # runs fn (in a worker process) with instrumentation on if it is on in the
+    # parent, and returns the spans it recorded alongside its result
+    global SPANS
+    SPANS = [] if on else None
+    try:
+        return fn(*args), SPANS
+    finally:
+        SPANS = None
+
+def extend(spans):
+    if SPANS is not None and spans:
+        SPANS.extend(spans)
+
+def summary(spans):
+    # total time, rows and memory of each stage of each table
+    totals = {}
+    for s in spans:
+        key = (s['name'], s.get('table'))
+        total = totals.setdefault(key, {'name': s['name'], 'table': s.get('table'),
+            'calls': 0, 'seconds': 0.0, 'rows_in': 0, 'rows_out': 0, 'rss_delta_mb': 0.0})
+        total['calls'] += 1
+        total['seconds'] += s['seconds']
+        total['rss_delta_mb'] += s['rss_delta_mb']
+        for rows in ['rows_in', 'rows_out']:
+            total[rows] += s.get(rows) or 0
+    return sorted(totals.values(), key=lambda t: -t['seconds'])
+
+def write_trace(path):
+    with open(path, 'w') as f:
+        json.dump({'spans': SPANS, 'summary': summary(SPANS)}, f, indent=1, default=str)
+
+def write_chrome_trace(path):
+    # trace event format, as loaded by chrome://tracing or Perfetto
+    events = [
+        {'name': s['name'], 'cat': 'merge_data', 'ph': 'X', 'pid': s['pid'], 'tid': 0,
+            'ts': s['start'] * 1e6, 'dur': s['seconds'] * 1e6,
+            'args': {k: v for k, v in s.items() if k not in ['name', 'start', 'seconds', 'pid']}}
+        for s in SPANS
+    ]
+    with open(path, 'w') as f:
+        json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, f, default=str)
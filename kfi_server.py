@@ -0,0 +1,183 @@
+#!/usr/bin/python3
+
+import pandas as pd
+import numpy as np
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlsplit, parse_qs, unquote
+import argparse
+import json
+import pathlib
+import sys
+
+from merge_data import (GROUP_COLS, KFI_FORMULAS, percentile_ranks, quantile_cube,
+    provider_groups, read_table)
+
+# short names accepted for the group filter columns in queries
+GROUP_ALIASES = {
+    'region': 'provider region',
+    'country': 'provider country',
+    'russell': 'russell group filter',
+    'pre92': 'pre 92 filter',
+    'post92': 'post 92 filter',
+}
+
+def json_records(tbl):
+    # rows as plain python dicts, with missing and infinite values (e.g. a
+    # ratio to zero) as null, which strict JSON has no other way to write
+    tbl = tbl.replace([np.inf, -np.inf], np.nan)
+    return tbl.astype(object).where(tbl.notna(), None).to_dict('records')
+
+def academic_year(year):
+    # '2021/22' from the URL path '/year/2021/22' or '2021-22'
+    return year.replace('-', '/')
+
+def build_index(kfi, groups=None):
+    # everything a query needs, worked out once: the rows of each provider,
+    # year and peer group, and the percentile ranks and quantiles of each
+    kfi = kfi.copy()
+    if groups is not None:
+        missing = [col for col in GROUP_COLS if col not in kfi.columns]
+        kfi = kfi.join(groups[missing], on='ukprn', how='inner')
+    kfi['ukprn'] = kfi['ukprn'].astype('int64')
+    for col in ['academic year'] + GROUP_COLS:
+        kfi[col] = kfi[col].astype('str')
+    kfi = kfi.sort_values(['ukprn', 'academic year']).reset_index(drop=True)
+    kfis = [name for name in KFI_FORMULAS if name in kfi.columns]
+
+    def positions(cols):
+        return {key: np.asarray(rows) for key, rows in kfi.groupby(cols).indices.items()}
+
+    ids = ['ukprn', 'he provider', 'academic year']
+    ranks = {'sector': percentile_ranks(kfi, kfis)}
+    for group in GROUP_COLS:
+        ranks[group] = percentile_ranks(kfi, kfis, group)
+
+    cube = quantile_cube(kfi, kfis, GROUP_COLS).round(3)
+    quantiles = {
+        key: json_records(rows.drop(columns=['group', 'academic year', 'level']))
+        for key, rows in cube.groupby(['group', 'academic year', 'level'])
+    }
+
+    return {
+        'kfis': kfis,
+        'levels': {group: sorted(kfi[group].unique()) for group in GROUP_COLS},
+        'years': sorted(kfi['academic year'].unique()),
+        'rows': json_records(kfi),
+        'provider': positions('ukprn'),
+        'year': positions('academic year'),
+        'peers': {group: positions(['academic year', group]) for group in GROUP_COLS},
+        'ranks': {
+            group: json_records(pd.concat([kfi[ids], rank.round(1)], axis=1))
+            for group, rank in ranks.items()
+        },
+        'quantiles': quantiles,
+    }
+
+def query(index, path):
+    # (HTTP status, JSON payload) for a request path:
+    #   /groups                         group columns, their levels and the years
+    #   /year/<year>                    every provider's KFIs in a year
+    # where a year is written 2021/22 or 2021-22 (in the path or as ?year=)
+    #   /provider/<ukprn>               the provider's KFIs in every year
+    #   /provider/<ukprn>/ranks?group=  its percentile ranks amongst its peers
+    #   /provider/<ukprn>/peers?group=&year=
+    #                                   the KFIs of its peers in a year
+    #   /provider/<ukprn>/quantiles?group=&year=
+    #                                   the quantiles of its peers' KFIs in a year
+    url = urlsplit(path)
+    parts = [unquote(part) for part in url.path.strip('/').split('/')]
+    params = {key: vals[-1] for key, vals in parse_qs(url.query).items()}
+    rows = index['rows']
+
+    if parts == ['groups']:
+        return 200, {'groups': index['levels'], 'years': index['years'], 'kfis': index['kfis']}
+
+    if parts[0] == 'year' and len(parts) in (2, 3):
+        year = academic_year('/'.join(parts[1:]))
+        if year not in index['year']:
+            return 404, {'error': f"No KFIs for the year <{year}>"}
+        return 200, [rows[i] for i in index['year'][year]]
+
+    if parts[0] != 'provider' or len(parts) not in (2, 3):
+        return 404, {'error': f"Unknown path <{url.path}>"}
+
+    if not parts[1].isdigit() or int(parts[1]) not in index['provider']:
+        return 404, {'error': f"<{parts[1]}> is not a valid UK Provider Number"}
+    own = index['provider'][int(parts[1])]
+    if len(parts) == 2:
+        return 200, [rows[i] for i in own]
+
+    group = params.get('group', 'russell')
+    group = GROUP_ALIASES.get(group, group)
+    if group not in index['ranks']:
+        return 400, {'error': f"Unknown group <{group}>"}
+
+    if parts[2] == 'ranks':
+        return 200, [index['ranks'][group][i] for i in own]
+
+    if parts[2] in ('peers', 'quantiles'):
+        year = academic_year(params.get('year', index['years'][-1]))
+        this_year = [i for i in own if rows[i]['academic year'] == year]
+        if not this_year:
+            return 404, {'error': f"No KFIs for {parts[1]} in <{year}>"}
+        if group == 'sector':
+            level, peers = 'all', index['year'][year]
+        else:
+            level = rows[this_year[0]][group]
+            peers = index['peers'][group][(year, level)]
+        if parts[2] == 'quantiles':
+            return 200, {'group': group, 'level': level, 'year': year,
+                'quantiles': index['quantiles'][(group, year, level)]}
+        return 200, {'group': group, 'level': level, 'year': year,
+            'peers': [rows[i] for i in peers]}
+
+    return 404, {'error': f"Unknown path <{url.path}>"}
+
+class KFIHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        status, payload = query(self.server.index, self.path)
+        # NaN/Infinity aren't JSON, json_records has made them null
+        body = json.dumps(payload, allow_nan=False).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        if not self.server.quiet:
+            super().log_message(format, *args)
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-i', '--input-csv', type=pathlib.Path, default=pathlib.Path('kfi.csv'),
+        help="Path to the KFI data (CSV, Parquet or Feather) that is served")
+    parser.add_argument('-g', '--provider-groups', type=pathlib.Path,
+        default=pathlib.Path('./data/provider_groups.csv'),
+        help="Provider group IDs, joined on for any group columns the KFI data lacks")
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('-p', '--port', type=int, default=8000)
+    parser.add_argument('-q', '--quiet', action='store_true',
+        help="Don't log each request")
+    args = parser.parse_args()
+
+    if not args.input_csv.exists():
+        sys.exit(f"The file <{args.input_csv}> does not exist.")
+    kfi = read_table(args.input_csv)
+    groups = None
+    if any(col not in kfi.columns for col in GROUP_COLS):
+        groups = provider_groups(args.provider_groups)
+
+    server = ThreadingHTTPServer((args.host, args.port), KFIHandler)
+    server.index = build_index(kfi, groups)
+    server.quiet = args.quiet
+    print(f"Serving the KFIs of {len(server.index['provider'])} providers on http://{args.host}:{server.server_port}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+if __name__ == "__main__":
+    main()
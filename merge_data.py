@@ -3,262 +3,926 @@
 import pandas as pd
 import numpy as np
 from zipfile import ZipFile as zf
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+import argparse
+import hashlib
+import json
+import os
+import pathlib
+import re
+import sys
 import pdb
 
-def make_negative(x):
-    if isinstance(x,str):
-        return '-' + x[1:-1] if x.startswith('(') else x
+import instrument
+from provider_store import write_store
+
+# pyarrow is only needed for the Parquet cache, the Parquet/Feather outputs
+# and the arrow parsing backend
+try:
+    import pyarrow
+    import pyarrow.compute as pc
+    import pyarrow.csv as pa_csv
+except ImportError:
+    pyarrow = None
+# numexpr is only used, when installed, to speed up the KFI formulas
+try:
+    import numexpr
+except ImportError:
+    numexpr = None
+
+# columns (lower case) that are never used from any of the HESA tables
+UNUSED_COLS = ['country of he provider', 'region of he provider', 'financial year end']
+
+# read schema for each HESA table: extra columns to skip and explicit dtypes,
+# keyed on lower case column names. Any other column that is read in holds
+# category metadata and is stored as a categorical.
+TABLE_SCHEMAS = {
+    1: {'skip': [], 'dtype': {}},
+    3: {'skip': [], 'dtype': {}},
+    4: {'skip': [], 'dtype': {}},
+    6: {'skip': [], 'dtype': {'source of fees': 'category'}},
+    7: {'skip': [], 'dtype': {}},
+    9: {'skip': [], 'dtype': {'type of asset': 'category'}},
+    11: {'skip': ['unit'], 'dtype': {'head of provider marker': 'category', 'remuneration': 'category'}},
+    12: {'skip': [], 'dtype': {}},
+}
+# dtypes of the columns shared by every table (ukprn is NaN for sector totals)
+BASE_DTYPES = {'ukprn': 'float64', 'he provider': 'str'}
+
+# categories kept from each HESA table
+CATEGORIES = {
+    1: ['Total income',
+        'Total expenditure',
+        'Surplus/(deficit) before other gains/losses and share of surplus/(deficit) in joint ventures and associates',
+        'Depreciation and amortisation',
+        'Interest and other finance costs'],
+    3: ['Total net assets/(liabilities)',
+        'Total current assets',
+        'Bank overdrafts ',
+        'Investments ',                 # Current assets 
+        'Total creditors (amounts falling due within one year)',
+        'Cash and cash equivalents ',
+        'Deferred course fees',
+        'Other (including grant claw back)',        # < 1 year
+        'Tax and social security costs',
+        'Total creditors (amounts falling due after more than one year)',
+        'Other (including grant claw back) ',       # > 1 year
+        'Income and expenditure reserve - unrestricted ',
+        'Revaluation reserve'],
+    4: ['Net cash inflow from operating activities',
+        'Depreciation',
+        'Interest paid',
+        'Repayments of amounts borrowed',
+        'Interest element of finance lease and service concession payments',
+        'Capital element of finance lease and service concession payments'],
+    6: ['Total tuition fees and education contracts',
+        'Total HE course fees',
+        'Total UK fees'],
+    7: ['Total research grants and contracts',
+        'Total other income',
+        'Total donations and endowments',
+        'Total residences and catering operations (including conferences)',
+        'Funding body grants'],         # income from
+    9: ['Total actual spend',
+        'Internal funds',
+        'Other external sources'],
+    11: ['Performance related pay and other bonuses',
+        'Total remuneration (before salary sacrifice)',
+        'Basic salary paid before salary sacrifice arrangements',
+        'Basic salary',
+        "Head of the provider's basic salary divided by the median pay (salary)",
+        "Head of the provider's total remuneration divided by the median total remuneration."],
+    12: ['Total staff costs',
+        'Average staff numbers (FTE) as disclosed in accounts',
+        'Total staff numbers (FTE) as disclosed in accounts',
+        'Total changes to pension provisions/ pension adjustments',
+        'Changes to pension provisions',
+        'Total salaries and wages',
+        'Salaries and wages academic staff',
+        'Salaries and wages non-academic staff',
+        'Average academic staff numbers (FTE)',
+        'Average non-academic staff numbers (FTE)']
+}
+
+# wide table categories used by the KFI formulas, by short name
+KFI_INPUTS = {
+    'income': 'Total income',
+    'total_expend': 'Total expenditure',
+    'surplus': 'Surplus/(deficit) before other gains/losses and share of surplus/(deficit) in joint ventures and associates',
+    'pension_provisions': 'Changes to pension provisions',
+    'pension_adjustments': 'Total changes to pension provisions/ pension adjustments',
+    'staff_costs': 'Total staff costs',
+    'unrestricted_reserve': 'Income and expenditure reserve - unrestricted ',
+    'revaluation_reserve': 'Revaluation reserve',
+    'creditors_short': 'Total creditors (amounts falling due within one year)',
+    'creditors_long': 'Total creditors (amounts falling due after more than one year)',
+    'overdrafts': 'Bank overdrafts ',
+    'deferred_fees': 'Deferred course fees',
+    'other_short': 'Other (including grant claw back)',
+    'other_long': 'Other (including grant claw back) ',
+    'net_assets': 'Total net assets/(liabilities)',
+    'current_assets': 'Total current assets',
+    'investments': 'Investments ',
+    'cash': 'Cash and cash equivalents ',
+    'ops_cash': 'Net cash inflow from operating activities',
+    'depreciation': 'Depreciation',
+    'interest_paid': 'Interest paid',
+    'repayments': 'Repayments of amounts borrowed',
+    'lease_interest': 'Interest element of finance lease and service concession payments',
+    'lease_capital': 'Capital element of finance lease and service concession payments',
+    'avg_staff_fte': 'Average staff numbers (FTE) as disclosed in accounts',
+    'total_staff_fte': 'Total staff numbers (FTE) as disclosed in accounts',
+    'salaries': 'Total salaries and wages',
+    'academic_salaries': 'Salaries and wages academic staff',
+    'academic_fte': 'Average academic staff numbers (FTE)',
+    'ps_salaries': 'Salaries and wages non-academic staff',
+    'ps_fte': 'Average non-academic staff numbers (FTE)',
+    'uk_fees': 'Total UK fees',
+    'he_fees': 'Total HE course fees',
+    'fbg': 'Funding body grants',
+    'research': 'Total research grants and contracts',
+    'donations': 'Total donations and endowments',
+    'residences': 'Total residences and catering operations (including conferences)',
+    'finance_costs': 'Interest and other finance costs',
+    'depreciate_amort': 'Depreciation and amortisation',
+    'capital_spend': 'Total actual spend',
+    'vc_bonus': 'Performance related pay and other bonuses',
+    'vc_basic_paid': 'Basic salary paid before salary sacrifice arrangements',
+    'vc_basic': 'Basic salary',
+    'vc_remuneration': 'Total remuneration (before salary sacrifice)',
+    'vc_median_salary_ratio': "Head of the provider's basic salary divided by the median pay (salary)",
+    'vc_median_remunerate_ratio': "Head of the provider's total remuneration divided by the median total remuneration.",
+}
+
+# terms shared between several KFIs
+KFI_TERMS = {
+    'pension_adjust': 'pension_provisions + pension_adjustments',
+    'expenditure': 'total_expend - pension_adjust',
+    'unreserves': 'unrestricted_reserve + revaluation_reserve',
+    'borrow': 'creditors_short - (overdrafts + deferred_fees + other_short) + creditors_long - other_long',
+    'liquidity': 'investments + cash - overdrafts',
+    'financing': 'interest_paid + repayments + lease_interest + lease_capital',
+    'total_staff_num': 'avg_staff_fte + total_staff_fte',
+    'basic': 'vc_basic_paid + vc_basic',
+}
+
+# Key Financial Indicators, in output column order
+KFI_FORMULAS = {
+    ## KFIs from Table-14
+    'surplus_vs_income': '(surplus + pension_adjust) / income',
+    'staff_vs_income': '(staff_costs - pension_adjust) / income',
+    'unrestricted_vs_income': 'unreserves / income',
+    'ext_borrow_vs_income': 'borrow / income',
+    # days ratio of total net assets to total expenditure
+    'net_assets_vs_expend': '365*net_assets / expenditure',
+    'current_assets_vs_liability': 'current_assets / creditors_short',
+    'ops_cash_vs_income': 'ops_cash / income',
+    'net_liquidity_days': '365*liquidity/(expenditure - depreciation)',
+    'debt_service_ratio': 'ops_cash / abs(financing)',
+    ## Other KFIs (of potential interest to staff)
+    # pay per FTE in k£
+    'avg_salary': 'salaries / total_staff_num',
+    'avg_remuneration': '(staff_costs - pension_adjust) / total_staff_num',
+    'academic_salary': 'academic_salaries / academic_fte',
+    'ps_staff_salary': 'ps_salaries / ps_fte',
+    # other sources as % of total income
+    'uk_vs_total_fees': 'uk_fees / he_fees',
+    'total_fees_vs_income': 'he_fees / income',
+    'fbg_vs_income': 'fbg / income',
+    'research_vs_income': 'research / income',
+    'donate_vs_income': 'donations / income',
+    'reside_cater_vs_income': 'residences / income',
+    'total_income': 'income',
+    'tuition_fees': 'he_fees',
+    # other expenditures
+    'finance_vs_expend': 'finance_costs / expenditure',
+    'depreciate_amort_vs_expend': 'depreciate_amort / expenditure',
+    'staff_vs_expend': '(staff_costs - pension_adjust) / expenditure',
+    'capital_vs_expend': 'capital_spend / expenditure',
+    'total_expenditure': 'expenditure',
+    # head of provider remuneration
+    'vc_bonus_vs_salary': 'vc_bonus / basic',
+    'vc_avg_salary': 'basic / avg_salary',
+    'vc_avg_remunerate': 'vc_remuneration / avg_remuneration',
+    # median staff salary from the above
+    'vc_median_salary': 'vc_median_salary_ratio',
+    'vc_median_remunerate': 'vc_median_remunerate_ratio',
+}
+
+# inputs, terms or other KFIs that each formula refers to
+KFI_DEPS = {
+    name: [dep for dep in compile(expr, '<kfi>', 'eval').co_names if dep != 'abs']
+    for name, expr in {**KFI_TERMS, **KFI_FORMULAS}.items()
+}
+
+# provider group columns joined onto the KFIs from provider_groups.csv
+GROUP_COLS = ['provider region', 'provider country', 'russell group filter',
+    'pre 92 filter', 'post 92 filter']
+
+# peer groups each provider's KFIs are compared within, and the quantiles of
+# every KFI that are stored for each of them
+PEER_GROUPS = ['russell group filter', 'pre 92 filter', 'post 92 filter', 'provider region']
+QUANTILES = [0, 0.05, 0.1, 0.25, 0.5, 0.75, 0.9, 0.95, 1]
+
+# bump whenever parse_table output changes, so cached tables are re-parsed
+SCHEMA_VERSION = 1
+
+# number of rows read in at a time, only the rows that pass the filters are kept
+CHUNK_ROWS = 50000
+# the same for the arrow backend, which reads blocks of bytes
+ARROW_BLOCK_BYTES = 1 << 23
+
+# number of averaged duplicate keys printed by pivot_wide
+DUPLICATES_SHOWN = 5
+
+# tables published as a single CSV, table 11 is a zip with a CSV per year
+CSV_TABLES = [1, 3, 4, 6, 7, 9, 12]
+
+# digests of the (table, academic year) partitions behind the outputs (and
+# their format and KFIs), which an incremental ingest checks the earlier years
+# against. Named with the outputs' prefix.
+MANIFEST = 'ingest_manifest.json'
+
+def read_header(csv_file):
+    header = pd.read_csv(csv_file, skiprows=12, nrows=0).columns
+    # rewind file objects so that the table itself can be read afterwards
+    if hasattr(csv_file, 'seek'):
+        csv_file.seek(0)
+    return header
+
+def read_schema(tbl_id, header):
+    schema = TABLE_SCHEMAS[tbl_id]
+    skip = UNUSED_COLS + schema['skip']
+    dtypes = {**BASE_DTYPES, **schema['dtype']}
+
+    usecols = [c for c in header if c.lower() not in skip]
+    dtype = {}
+    for col in usecols:
+        name = col.lower()
+        if name in dtypes:
+            dtype[col] = dtypes[name]
+        elif 'value' in name:
+            # parsed into numbers once the accounting negatives are handled
+            dtype[col] = 'str'
+        else:
+            dtype[col] = 'category'
+    return usecols, dtype
+
+def parse_values(values):
+    # accounting style numbers: thousands separators, negatives in parentheses
+    # and blanks for missing values
+    text = values.str.strip().str.replace(',', '', regex=False)
+    negative = text.str.startswith('(', na=False)
+    numbers = text.str.strip('()').replace('', np.nan).astype('float64')
+    return numbers.where(~negative, -numbers)
+
+def category_layout(tbl_id, columns):
+    # category metadata columns to drop, the category column is then the one
+    # just before the value column
+    if tbl_id==12:
+        drop_cols = [columns[4]]
+    elif tbl_id==6:
+        drop_cols = list(columns[[2,4]])
+    elif tbl_id==11:
+        drop_cols = [columns[3]]
     else:
-        return x
+        drop_cols = list(columns[3:-2])
+    cat_col = [c for c in columns if c not in drop_cols][-2]
+
+    return drop_cols, cat_col
 
 def rename_category_col(tbl_id, long):
-    if tbl_id==12:
-        drop_cols = long.columns[4]
-    elif tbl_id==6:
+    if tbl_id==6:
         long = long[long['source of fees']=='Total']
-        drop_cols = list(long.columns[[2,4]])
     elif tbl_id==11:
         long = long[
             (long['head of provider marker']=='Total') | ( 
                 (long['remuneration'].str.startswith('Head of')) & (long['value'] != '0')
             )
         ]
-        drop_cols = list(long.columns[[3,5]])
-    else:
-        if tbl_id==9:
-            long = long[long['type of asset']=='Total capital expenditure']
-        drop_cols = list(long.columns[3:-2])
+    elif tbl_id==9:
+        long = long[long['type of asset']=='Total capital expenditure']
+    drop_cols, cat_col = category_layout(tbl_id, long.columns)
     # dropping category metadata columns
     if drop_cols:
         long = long.drop(columns=drop_cols)
 
-    return long.rename(columns={long.columns[-2]: 'category'})
-
-def filter_categories(tbl_id, unfiltered):
-    cats = {
-        1: ['Total income',
-            'Total expenditure',
-            'Surplus/(deficit) before other gains/losses and share of surplus/(deficit) in joint ventures and associates',
-            'Depreciation and amortisation',
-            'Interest and other finance costs'],
-        3: ['Total net assets/(liabilities)',
-            'Total current assets',
-            'Bank overdrafts ',
-            'Investments ',                 # Current assets 
-            'Total creditors (amounts falling due within one year)',
-            'Cash and cash equivalents ',
-            'Deferred course fees',
-            'Other (including grant claw back)',        # < 1 year
-            'Tax and social security costs',
-            'Total creditors (amounts falling due after more than one year)',
-            'Other (including grant claw back) ',       # > 1 year
-            'Income and expenditure reserve - unrestricted ',
-            'Revaluation reserve'],
-        4: ['Net cash inflow from operating activities',
-            'Depreciation',
-            'Interest paid',
-            'Repayments of amounts borrowed',
-            'Interest element of finance lease and service concession payments',
-            'Capital element of finance lease and service concession payments'],
-        6: ['Total tuition fees and education contracts',
-            'Total HE course fees',
-            'Total UK fees'],
-        7: ['Total research grants and contracts',
-            'Total other income',
-            'Total donations and endowments',
-            'Total residences and catering operations (including conferences)',
-            'Funding body grants'],         # income from
-        9: ['Total actual spend',
-            'Internal funds',
-            'Other external sources'],
-        11: ['Performance related pay and other bonuses',
-            'Total remuneration (before salary sacrifice)',
-            'Basic salary paid before salary sacrifice arrangements',
-            'Basic salary',
-            "Head of the provider's basic salary divided by the median pay (salary)",
-            "Head of the provider's total remuneration divided by the median total remuneration."],
-        12: ['Total staff costs',
-            'Average staff numbers (FTE) as disclosed in accounts',
-            'Total staff numbers (FTE) as disclosed in accounts',
-            'Total changes to pension provisions/ pension adjustments',
-            'Changes to pension provisions',
-            'Total salaries and wages',
-            'Salaries and wages academic staff',
-            'Salaries and wages non-academic staff',
-            'Average academic staff numbers (FTE)',
-            'Average non-academic staff numbers (FTE)']
-    }
+    return long.rename(columns={cat_col: 'category'})
 
-    categories = cats[tbl_id]
-    return unfiltered[ unfiltered['category'].isin(categories) ]
+def filter_categories(tbl_id, unfiltered, cat_col='category'):
+    categories = CATEGORIES[tbl_id]
+    return unfiltered[ unfiltered[cat_col].isin(categories) ]
 
-def parse_zip(tbl_id):
-    zip_file = f"./data/table-{tbl_id}.zip"
+def zip_members(tbl_id):
+    with zf(f"./data/table-{tbl_id}.zip", 'r') as z:
+        return z.namelist()
 
-    tbls = []
+def parse_member(tbl_id, fname, backend='pandas'):
     # open zip file
-    with zf(zip_file, 'r') as z:
-        z.extractall(path='./data')
+    with zf(f"./data/table-{tbl_id}.zip", 'r') as z:
+        # stream the member straight into the parser, nothing is extracted
+        with z.open(fname) as csv_file:
+            return PARSERS[backend](tbl_id, csv_file=csv_file)
 
-        for fname in z.namelist():
-            tbl = parse_table(tbl_id, csv_file='./data/'+fname)
-            tbls.append(tbl)            
+def parse_zip(tbl_id, backend='pandas'):
+    tbls = [parse_member(tbl_id, fname, backend) for fname in zip_members(tbl_id)]
     # concat tables together
     return pd.concat(tbls, ignore_index=True)
 
+def source_digest(tbl_id, fname=None):
+    if fname:
+        # zip members already carry a CRC of their uncompressed contents
+        with zf(f"./data/table-{tbl_id}.zip", 'r') as z:
+            info = z.getinfo(fname)
+        return f"{fname}:{info.CRC:08x}:{info.file_size}"
+
+    digest = hashlib.sha256()
+    with open(f"./data/table-{tbl_id}.csv", 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+def cache_key(tbl_id, fname=None):
+    # parsed output depends on the file contents, the kept categories and the schema
+    key = {
+        'source': source_digest(tbl_id, fname),
+        'categories': CATEGORIES[tbl_id],
+        'schema': TABLE_SCHEMAS[tbl_id],
+        'version': SCHEMA_VERSION,
+    }
+    return hashlib.sha256(json.dumps(key, sort_keys=True).encode()).hexdigest()
+
+def cached_parse(cache_dir, fn, tbl_id, *args):
+    name = args[0] if args else f"./data/table-{tbl_id}.csv"
+    with instrument.span('parse', table=tbl_id, file=name, cached=False) as s:
+        if cache_dir is None:
+            tbl = fn(tbl_id, *args)
+            s['rows_out'] = len(tbl)
+            return tbl
+
+        cache_file = cache_dir.joinpath(f"table-{tbl_id}-{cache_key(tbl_id, *args)}.parquet")
+        if cache_file.exists():
+            print(f"{name} (cached)")
+            tbl = pd.read_parquet(cache_file)
+            s.update(cached=True, rows_out=len(tbl))
+            return tbl
+
+        tbl = fn(tbl_id, *args)
+        # write then rename, so a half written file is never picked up
+        tmp_file = cache_file.with_suffix(f".{os.getpid()}.tmp")
+        tbl.to_parquet(tmp_file, index=False)
+        os.replace(tmp_file, cache_file)
+        s['rows_out'] = len(tbl)
+        return tbl
+
+def kfi_tables(indicators=None):
+    # the HESA tables holding the categories the requested KFIs are worked out from
+    inputs, _ = kfi_plan(indicators)
+    categories = {KFI_INPUTS[name] for name in inputs}
+    return [T for T, cats in CATEGORIES.items() if categories.intersection(cats)]
+
+def member_year(fname):
+    # academic year of a table 11 member, e.g. 'table-11-(2016-17).csv' -> '2016/17'
+    start, end = re.search(r'\((\d{4})-(\d{2})\)', fname).groups()
+    return f"{start}/{end}"
+
+def partition_digests(long):
+    # digest of the parsed rows of each academic year of a table
+    return {
+        year: hashlib.sha256(pd.util.hash_pandas_object(part, index=False).to_numpy()).hexdigest()
+        for year, part in long.groupby('academic year', sort=True)
+    }
+
+def source_partitions(csv_tbls, members):
+    # {table: {academic year: digest}} of the parsed CSV tables, and of table
+    # 11 from its zip members alone, so its earlier years are never re-parsed
+    parts = {str(T): partition_digests(long) for T, long in csv_tbls.items()}
+    parts['11'] = {member_year(fname): source_digest(11, fname) for fname in members}
+    return parts
+
+def compare_partitions(manifest, parts):
+    # partitions missing from the manifest, and those in it which have since
+    # changed or gone
+    new = [(T, year) for T, years in parts.items() for year in years if year not in manifest.get(T, {})]
+    changed = [
+        (T, year) for T, years in manifest.items() for year, digest in years.items()
+        if parts.get(T, {}).get(year) != digest
+    ]
+    return new, changed
+
+def read_manifest(path=MANIFEST):
+    manifest = json.loads(pathlib.Path(path).read_text())
+    if manifest['version'] != SCHEMA_VERSION:
+        raise ValueError(f"The manifest <{path}> is from version {manifest['version']}, not {SCHEMA_VERSION}")
+    return manifest
+
+def write_manifest(parts, fmt, kfis, path=MANIFEST):
+    # written after the outputs, so it never describes outputs that weren't
+    manifest = {'version': SCHEMA_VERSION, 'format': fmt, 'kfis': kfis, 'partitions': parts}
+    tmp_file = pathlib.Path(f"{path}.{os.getpid()}.tmp")
+    tmp_file.write_text(json.dumps(manifest, indent=1))
+    os.replace(tmp_file, path)
+
+def new_year_tables(jobs=1, cache_dir=None, backend='pandas', fmt='csv', path=MANIFEST):
+    # the parsed rows of the academic years with a partition missing from the
+    # manifest. The single CSV tables are read to find their new rows, but only
+    # the zip members of table 11 for those years are parsed.
+    try:
+        manifest = read_manifest(path)
+    except FileNotFoundError:
+        sys.exit(f"No <{path}> to ingest incrementally against, run a full ingest first.")
+    except ValueError as err:
+        sys.exit(f"{err}, run a full ingest.")
+    # only outputs of every KFI, in the format being appended to, can be added to
+    if manifest['format'] != fmt or manifest['kfis'] != list(KFI_FORMULAS):
+        sys.exit(f"<{path}> is of {manifest['format']} outputs of {len(manifest['kfis'])} KFIs, "
+            f"not {fmt} outputs of all {len(KFI_FORMULAS)}, run a full ingest.")
+    manifest = manifest['partitions']
+
+    csv_tbls = dict(zip(CSV_TABLES, parse_tables(jobs, cache_dir, backend, tables=CSV_TABLES)))
+    members = zip_members(11)
+    parts = source_partitions(csv_tbls, members)
+
+    new, changed = compare_partitions(manifest, parts)
+    if changed:
+        listed = ', '.join(f"table {T} {year}" for T, year in changed)
+        sys.exit(f"Earlier years have changed since the last ingest ({listed}), run a full ingest.")
+    years = sorted({year for T, year in new})
+
+    tbls = [long[long['academic year'].isin(years)] for long in csv_tbls.values()]
+    tbls += parse_tables(jobs, cache_dir, backend, tables=[11],
+        members=[fname for fname in members if member_year(fname) in years])
+    return tbls, years, parts
+
+def append_years(old, new, years):
+    # old's rows outside the given years followed by new's, in the order
+    # pivot_wide gives them
+    old = old[~old['academic year'].astype(str).isin(years)]
+    merged = pd.concat([old, new], ignore_index=True)
+    merged = merged.sort_values(['ukprn', 'he provider', 'academic year'], kind='stable')
+    return merged.reset_index(drop=True)
+
+def parse_tables(jobs=1, cache_dir=None, backend='pandas', tables=None, members=None):
+    # one task per CSV file or zip member, of all tables (and all members of
+    # table 11) unless given
+    if tables is None:
+        tables = list(CATEGORIES)
+    tasks = [(PARSERS[backend], T) for T in CSV_TABLES if T in tables]
+    if 11 in tables:
+        if members is None:
+            members = zip_members(11)
+        tasks += [(partial(parse_member, backend=backend), 11, fname) for fname in members]
+
+    if jobs > 1:
+        with ProcessPoolExecutor(max_workers=jobs) as pool:
+            # spans recorded in the workers are sent back with each table
+            futures = [
+                pool.submit(instrument.collect, instrument.enabled(), cached_parse, cache_dir, *task)
+                for task in tasks
+            ]
+            # collected in task order so the output matches a serial run
+            results = [f.result() for f in futures]
+        for tbl, spans in results:
+            instrument.extend(spans)
+        return [tbl for tbl, spans in results]
+    return [cached_parse(cache_dir, *task) for task in tasks]
+
 def parse_table(tbl_id, csv_file=None):
     if not csv_file:
         csv_file = f"./data/table-{tbl_id}.csv"
-    print(csv_file)
-
-    full_tbl = pd.read_csv(csv_file, skiprows=12)
-    # make all column names lower case for easier filtering
-    full_tbl.columns = full_tbl.columns.str.lower()
-    # drop unneed columns
-    tbl = full_tbl.drop(columns=['country of he provider','region of he provider'])
-    if 'financial year end' in tbl.columns:
-        tbl.drop(columns=['financial year end'], inplace=True) 
-    # filter out sector totals
-    tbl.dropna(subset=["ukprn"], inplace=True)
-
-    # remove 2015/16
-    df = tbl[ tbl['academic year']!='2015/16' ]
-    # keep only rows for end-of-year report
-    if 'year end month' in df.columns:
-        df = df[ df['year end month']=='All' ]
-        df.drop(columns=['year end month'], inplace=True) 
-    
-    # rename value column
-    val_col = [c for c in df.columns if 'value' in c][0]
-    df = df.rename(columns={val_col:'value'})
-    # remove NaN values from "value" column
-    df = df.dropna(subset=["value"])
-
-    # convert values in parenthese into negative numbers
-    numbers = df['value'].apply(make_negative)
-    df.update(numbers)
-    
-    # drop excess category metadata
-    narrowed = rename_category_col(tbl_id, df)
-    # select only the desired categories from each file
-    long = filter_categories(tbl_id, narrowed)
-
-    return long
-
-def key_financial_indicators(wide):
-    # start with institutional & year indetifiers
-    kfi = wide.loc[:,['ukprn', 'he provider', 'academic year']]
-
-    ## KFIs from Table-14
-    # annual surplus as % of income
-    income = wide['Total income']
-    pension_adjust = wide['Changes to pension provisions'] + \
-        wide['Total changes to pension provisions/ pension adjustments']
-    expenditure = wide['Total expenditure'] - pension_adjust
-    
-    surplus = wide['Surplus/(deficit) before other gains/losses and share of surplus/(deficit) in joint ventures and associates']
-    kfi['surplus_vs_income'] = (surplus + pension_adjust) / income 
-
-    # staff costs as % of income
-    kfi['staff_vs_income'] = (wide['Total staff costs'] - pension_adjust) / income
-
-    # unrestricted reserves as % of income
-    unreserves = wide['Income and expenditure reserve - unrestricted '] + wide['Revaluation reserve']
-    kfi['unrestricted_vs_income'] = unreserves / income
-
-    # external borrowing as % of income
-    borrow = wide['Total creditors (amounts falling due within one year)'] - \
-        (wide['Bank overdrafts '] + wide['Deferred course fees'] + wide['Other (including grant claw back)']) + \
-        wide['Total creditors (amounts falling due after more than one year)'] - \
-        wide['Other (including grant claw back) ']
-    kfi['ext_borrow_vs_income'] = borrow / income
-
-    # Days ratio of Total net assets to total expenditure
-    kfi['net_assets_vs_expend'] = 365*wide['Total net assets/(liabilities)'] / expenditure
-
-    # Ratio of current assets to current liabilities
-    kfi['current_assets_vs_liability'] = wide['Total current assets'] / \
-        wide['Total creditors (amounts falling due within one year)']
-
-    # Net cash inflow from operating activities as a % of income
-    kfi['ops_cash_vs_income'] = wide['Net cash inflow from operating activities'] / income
-
-    # Net liquidity days
-    liquidity = wide['Investments '] + wide['Cash and cash equivalents '] - wide['Bank overdrafts ']
-    kfi['net_liquidity_days'] = 365*liquidity/(expenditure - wide['Depreciation'])
-
-    # Debt service ratio
-    financing = wide['Interest paid'] + wide['Repayments of amounts borrowed'] + \
-        wide['Interest element of finance lease and service concession payments'] + \
-        wide['Capital element of finance lease and service concession payments']
-    kfi['debt_service_ratio'] = wide['Net cash inflow from operating activities'] / np.abs(financing)
-
-    ## Other KFIs (of potential interest to staff)
-    # Pay per FTE in k£
-    total_staff_num = wide['Average staff numbers (FTE) as disclosed in accounts'] + \
-        wide['Total staff numbers (FTE) as disclosed in accounts']
-    kfi['avg_salary'] = wide['Total salaries and wages'] / total_staff_num
-    kfi['avg_remuneration'] = (wide['Total staff costs'] - pension_adjust) / total_staff_num
-    kfi['academic_salary'] = wide['Salaries and wages academic staff'] / wide['Average academic staff numbers (FTE)']
-    kfi['ps_staff_salary'] = wide['Salaries and wages non-academic staff'] / wide['Average non-academic staff numbers (FTE)']
-
-    # Other sources as % of total income
-    kfi['uk_vs_total_fees'] = wide['Total UK fees'] / wide['Total HE course fees']
-    kfi['total_fees_vs_income'] = wide['Total HE course fees'] / income 
-    kfi['fbg_vs_income'] = wide['Funding body grants'] / income
-    kfi['research_vs_income'] = wide['Total research grants and contracts'] / income
-    kfi['donate_vs_income'] = wide['Total donations and endowments'] / income
-    kfi['reside_cater_vs_income'] = wide['Total residences and catering operations (including conferences)'] / income
-    kfi['total_income'] = income
-    kfi['tuition_fees'] = wide['Total HE course fees']
-
-    # Other expenditures
-    kfi['finance_vs_expend'] = wide['Interest and other finance costs'] / expenditure
-    kfi['depreciate_amort_vs_expend'] = wide['Depreciation and amortisation'] / expenditure
-    kfi['staff_vs_expend'] = (wide['Total staff costs'] - pension_adjust) / expenditure
-    kfi['capital_vs_expend'] = wide['Total actual spend'] / expenditure
-    kfi['total_expenditure'] = expenditure
-
-    # Head of provider remuneration
-    basic = wide['Basic salary paid before salary sacrifice arrangements'] + wide['Basic salary']
-    remuneration = wide['Total remuneration (before salary sacrifice)']
-    kfi['vc_bonus_vs_salary'] = wide['Performance related pay and other bonuses'] / basic
-    kfi['vc_avg_salary'] = basic / kfi['avg_salary']
-    kfi['vc_avg_remunerate'] = remuneration / kfi['avg_remuneration']
-    # Median staff salary from the above
-    kfi['vc_median_salary'] = wide["Head of the provider's basic salary divided by the median pay (salary)"]
-    kfi['vc_median_remunerate'] = wide["Head of the provider's total remuneration divided by the median total remuneration."]
-
-    return kfi
+    # file objects (e.g. zip members) are reported by name
+    print(getattr(csv_file, 'name', csv_file))
+
+    # only read in the needed columns, with their dtypes declared up front
+    usecols, dtype = read_schema(tbl_id, read_header(csv_file))
+    reader = pd.read_csv(
+        csv_file, skiprows=12, usecols=usecols, dtype=dtype, chunksize=CHUNK_ROWS)
+    # rows are filtered as they are read, so only the kept rows are ever held
+    chunks = [
+        filter_chunk(tbl_id, chunk)
+        for chunk in instrument.iterate('read', reader, table=tbl_id)
+    ]
+    long = pd.concat(chunks, ignore_index=True)
+
+    # the kept rows are few, so turn the categorical keys back into strings
+    return long.astype({'he provider': 'str', 'academic year': 'str', 'category': 'str'})
+
+def filter_chunk(tbl_id, tbl):
+    with instrument.span('filter', table=tbl_id, rows_in=len(tbl)) as s:
+        # make all column names lower case for easier filtering
+        tbl.columns = tbl.columns.str.lower()
+        # filter out sector totals
+        tbl = tbl.dropna(subset=["ukprn"])
+
+        # remove 2015/16
+        df = tbl[ tbl['academic year']!='2015/16' ]
+        # keep only rows for end-of-year report
+        if 'year end month' in df.columns:
+            df = df[ df['year end month']=='All' ]
+            df = df.drop(columns=['year end month'])
+
+        # rename value column
+        val_col = [c for c in df.columns if 'value' in c][0]
+        df = df.rename(columns={val_col:'value'})
+
+        # select only the desired categories before any per-row work is done
+        _, cat_col = category_layout(tbl_id, df.columns)
+        df = filter_categories(tbl_id, df, cat_col)
+        s['rows_out'] = len(df)
+
+    with instrument.span('rename', table=tbl_id, rows_in=len(df)) as s:
+        # drop excess category metadata
+        df = rename_category_col(tbl_id, df)
+        s['rows_out'] = len(df)
+
+    with instrument.span('negate', table=tbl_id, rows_in=len(df)) as s:
+        # convert values into numbers in one vectorised pass
+        df = df.assign(value=parse_values(df['value']))
+        # remove NaN values from "value" column
+        df = df.dropna(subset=["value"])
+        s['rows_out'] = len(df)
+    return df
+
+def parse_table_arrow(tbl_id, csv_file=None):
+    # parse_table on pyarrow: the CSV is streamed in blocks which are filtered
+    # as they are read, and only the kept rows are ever turned into pandas
+    if not csv_file:
+        csv_file = f"./data/table-{tbl_id}.csv"
+    print(getattr(csv_file, 'name', csv_file))
+
+    usecols, _ = read_schema(tbl_id, read_header(csv_file))
+    reader = pa_csv.open_csv(
+        csv_file,
+        read_options=pa_csv.ReadOptions(skip_rows=12, block_size=ARROW_BLOCK_BYTES),
+        convert_options=pa_csv.ConvertOptions(
+            include_columns=usecols,
+            column_types={col: pyarrow.string() for col in usecols},
+            strings_can_be_null=True))
+    batches = [
+        filter_batch(tbl_id, batch)
+        for batch in instrument.iterate('read', reader, table=tbl_id)
+    ]
+    long = pyarrow.Table.from_batches(batches).to_pandas()
+
+    return long.astype({'he provider': 'str', 'academic year': 'str', 'category': 'str'})
+
+def filter_batch(tbl_id, batch):
+    # the rows and columns filter_chunk keeps, with pyarrow compute. Missing
+    # values compare as they do in pandas: unequal to anything, in no list.
+    with instrument.span('filter', table=tbl_id, rows_in=len(batch)) as s:
+        cols = dict(zip([name.lower() for name in batch.schema.names], batch.columns))
+        keep = [
+            pc.is_valid(cols['ukprn']),
+            pc.fill_null(pc.not_equal(cols['academic year'], '2015/16'), True),
+        ]
+        if 'year end month' in cols:
+            keep.append(pc.fill_null(pc.equal(cols.pop('year end month'), 'All'), False))
+
+        _, cat_col = category_layout(tbl_id, pd.Index(cols))
+        keep.append(pc.fill_null(pc.is_in(cols[cat_col], pyarrow.array(CATEGORIES[tbl_id])), False))
+
+        # the rows rename_category_col keeps
+        if tbl_id==6:
+            keep.append(pc.fill_null(pc.equal(cols['source of fees'], 'Total'), False))
+        elif tbl_id==11:
+            val_col = [c for c in cols if 'value' in c][0]
+            keep.append(pc.or_(
+                pc.fill_null(pc.equal(cols['head of provider marker'], 'Total'), False),
+                pc.and_(
+                    pc.fill_null(pc.starts_with(cols['remuneration'], 'Head of'), False),
+                    pc.fill_null(pc.not_equal(cols[val_col], '0'), True))
+            ))
+        elif tbl_id==9:
+            keep.append(pc.fill_null(pc.equal(cols['type of asset'], 'Total capital expenditure'), False))
+
+        mask = keep[0]
+        for k in keep[1:]:
+            mask = pc.and_(mask, k)
+        val_col = [c for c in cols if 'value' in c][0]
+        batch = pyarrow.RecordBatch.from_arrays(
+            [pc.filter(cols[c], mask) for c in ['ukprn', 'he provider', 'academic year', cat_col, val_col]],
+            names=['ukprn', 'he provider', 'academic year', 'category', 'value'])
+        s['rows_out'] = len(batch)
+
+    with instrument.span('negate', table=tbl_id, rows_in=len(batch)) as s:
+        values = parse_values_arrow(batch.column('value'))
+        batch = pyarrow.RecordBatch.from_arrays(
+            [pc.cast(batch.column('ukprn'), pyarrow.float64())] + batch.columns[1:4] + [values],
+            names=batch.schema.names)
+        # remove NaN values from "value" column
+        batch = batch.filter(pc.fill_null(pc.invert(pc.is_nan(values)), False))
+        s['rows_out'] = len(batch)
+    return batch
+
+def parse_values_arrow(values):
+    # parse_values with pyarrow compute
+    text = pc.replace_substring(pc.utf8_trim_whitespace(values), ',', '')
+    negative = pc.fill_null(pc.starts_with(text, '('), False)
+    text = pc.utf8_trim(text, '()')
+    numbers = pc.cast(pc.if_else(pc.equal(text, ''), pyarrow.scalar(None, pyarrow.string()), text),
+        pyarrow.float64())
+    return pc.if_else(negative, pc.negate(numbers), numbers)
+
+# how the HESA tables are parsed, the pandas parser being the reference
+PARSERS = {'pandas': parse_table, 'arrow': parse_table_arrow}
+
+def pivot_wide(long, index=['ukprn','he provider','academic year'], duplicates='mean'):
+    # integer codes for every row key and category, sorted as pivot_table would
+    keys = np.column_stack([pd.factorize(long[col], sort=True)[0] for col in index])
+    rows, row_codes = np.unique(keys, axis=0, return_inverse=True)
+    cat_codes, categories = pd.factorize(long['category'], sort=True)
+
+    # scatter the values into a dense matrix, missing cells are left as 0
+    matrix = np.zeros((len(rows), len(categories)), dtype='float64')
+    cells = row_codes.ravel() * len(categories) + cat_codes
+    values = long['value'].to_numpy(dtype='float64')
+    matrix.flat[cells] = values
+
+    # (provider, year, category) keys which appear more than once, counted
+    # without a second array the size of the matrix
+    unique_cells, counts = np.unique(cells, return_counts=True)
+    repeated = unique_cells[counts > 1]
+    if len(repeated):
+        dups = np.flatnonzero(np.isin(cells, repeated))
+        if duplicates == 'raise':
+            raise ValueError(f"{len(repeated)} repeated keys in the long table:\n{long.iloc[dups].to_string(index=False)}")
+        # average the (few) repeated values, exactly as pivot_table would, and
+        # name the first of them (duplicates='raise' lists them all)
+        keys = long.iloc[dups][index + ['category']].drop_duplicates().sort_values(index + ['category'])
+        print(f"Averaging the values of {len(repeated)} repeated keys, e.g.\n"
+            f"{keys.head(DUPLICATES_SHOWN).to_string(index=False)}")
+        means = pd.Series(values[dups]).groupby(cells[dups]).mean()
+        matrix.flat[means.index] = means.to_numpy()
+
+    # row identifiers followed by a column per category
+    ids = pd.DataFrame({
+        col: pd.factorize(long[col], sort=True)[1][rows[:, i]]
+        for i, col in enumerate(index)
+    })
+    wide = pd.DataFrame(matrix, columns=pd.Index(categories, name='category'))
+    return pd.concat([ids, wide], axis=1)
+
+def evaluate(expr, arrays):
+    if numexpr is not None:
+        return numexpr.evaluate(expr, local_dict=arrays)
+    return eval(expr, {'__builtins__': {}, 'abs': np.abs}, arrays)
+
+def kfi_plan(indicators=None):
+    # the inputs to pull and the terms/KFIs to evaluate for the requested
+    # indicators, each once and after everything it depends on
+    if indicators is None:
+        indicators = list(KFI_FORMULAS)
+    unknown = [name for name in indicators if name not in KFI_DEPS]
+    if unknown:
+        raise ValueError(f"Unknown KFIs: {', '.join(unknown)}")
+
+    inputs, plan = [], []
+    def visit(name):
+        if name in inputs or name in plan:
+            return
+        if name in KFI_INPUTS:
+            inputs.append(name)
+        else:
+            for dep in KFI_DEPS[name]:
+                visit(dep)
+            plan.append(name)
+    for name in indicators:
+        visit(name)
+
+    return inputs, plan
+
+def kfi_engine(arrays, indicators=None):
+    if indicators is None:
+        indicators = list(KFI_FORMULAS)
+    _, plan = kfi_plan(indicators)
+
+    # evaluate only the terms and KFIs needed, shared terms are computed once
+    env = dict(arrays)
+    formulas = {**KFI_TERMS, **KFI_FORMULAS}
+    with np.errstate(divide='ignore', invalid='ignore'):
+        for name in plan:
+            env[name] = evaluate(formulas[name], env)
+
+    return {name: env[name] for name in indicators}
+
+def key_financial_indicators(wide, indicators=None):
+    # pull only the categories the requested formulas use, as plain arrays
+    inputs, _ = kfi_plan(indicators)
+    arrays = {
+        name: wide[KFI_INPUTS[name]].to_numpy(dtype='float64')
+        for name in inputs
+    }
+    results = kfi_engine(arrays, indicators)
+
+    # institutional & year identifiers followed by the KFIs
+    ids = {col: wide[col] for col in ['ukprn', 'he provider', 'academic year']}
+    return pd.DataFrame({**ids, **results}, index=wide.index)
+
+def percentile_ranks(kfi, kfis, group=None):
+    # percentile (0-100) of each row's KFIs amongst the rows of the same year,
+    # and the same level of the group column if one is given
+    keys = ['academic year'] if group is None else ['academic year', group]
+    return kfi.groupby(keys, observed=True)[kfis].rank(pct=True) * 100
+
+def peer_ranks(kfi, kfis, groups=PEER_GROUPS):
+    # each provider's percentile ranks within the whole sector ('all') and
+    # within its level of each peer group, one row per provider, year and group
+    ids = kfi[['ukprn', 'he provider', 'academic year']]
+    ranks = {'sector': pd.concat([ids.assign(level='all'), percentile_ranks(kfi, kfis)], axis=1)}
+    for group in groups:
+        rank = percentile_ranks(kfi, kfis, group)
+        ranks[group] = pd.concat([ids.assign(level=kfi[group]), rank], axis=1)
+    ranks = pd.concat(ranks, names=['group']).reset_index(level='group')
+    return ranks.reset_index(drop=True)
+
+def quantile_cube(kfi, kfis, groups=PEER_GROUPS):
+    # the QUANTILES of every KFI per year, for the whole sector ('all') and
+    # each level of each peer group
+    levels = {'sector': pd.Series('all', index=kfi.index)}
+    levels.update({group: kfi[group] for group in groups})
+    cube = {
+        group: kfi[kfis].groupby([kfi['academic year'], level.rename('level')], observed=True)
+            .quantile(QUANTILES).rename_axis(['academic year', 'level', 'quantile'])
+        for group, level in levels.items()
+    }
+    return pd.concat(cube, names=['group']).reset_index()
 
+def provider_groups(path='./data/provider_groups.csv'):
+    # provider group IDs, indexed by ukprn
+    pg = pd.read_csv(path)
+    pg = pg.rename(str.lower, axis='columns')
+    pg = pg.rename(columns={'provider ukprn':'ukprn'})
+    return pg.set_index('ukprn')
+
+def typed_table(tbl):
+    # ukprn as an integer, the year and the provider groups as categoricals
+    # (in order of appearance, as they are read from a CSV)
+    types = {'ukprn': 'int64'} if 'ukprn' in tbl.columns else {}
+    for col in ['academic year'] + GROUP_COLS:
+        if col in tbl.columns:
+            types[col] = pd.CategoricalDtype(tbl[col].dropna().unique())
+    return tbl.astype(types).reset_index(drop=True)
+
+def write_table(tbl, name, fmt='csv', **kwargs):
+    if fmt == 'parquet':
+        typed_table(tbl).to_parquet(f'{name}.parquet', index=False)
+    elif fmt == 'feather':
+        typed_table(tbl).to_feather(f'{name}.feather')
+    else:
+        tbl.to_csv(f'{name}.csv', **kwargs)
+
+def read_table(path, **kwargs):
+    # typed Parquet/Feather outputs load without re-inferring dtypes, kwargs
+    # go to read_csv as write_table's go to to_csv
+    path = pathlib.Path(path)
+    if path.suffix == '.parquet':
+        return pd.read_parquet(path)
+    elif path.suffix == '.feather':
+        return pd.read_feather(path)
+    return pd.read_csv(path, **kwargs)
 
 def main():
-    tbls = [parse_table(T) for T in [1,3,4,6,7,9,12]]
-    tbls.append(parse_zip(11))
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-j', '--jobs', type=int, default=1,
+        help="Number of processes used to parse the HESA tables")
+    parser.add_argument('-c', '--cache-dir', type=pathlib.Path,
+        help="Directory of cached parsed tables, only changed inputs are re-parsed")
+    parser.add_argument('-f', '--output-format', choices=['csv', 'parquet', 'feather'],
+        default='csv', help="File format of the wide and KFI tables")
+    parser.add_argument('-b', '--backend', choices=['pandas', 'arrow'], default='pandas',
+        help="Library the HESA tables are parsed with, pandas is the reference")
+    parser.add_argument('-d', '--duplicates', choices=['mean', 'raise'], default='mean',
+        help="Average the values of repeated (provider, year, category) keys, or stop at them")
+    parser.add_argument('-k', '--kfi', type=lambda s: s.split(','),
+        help="Comma separated KFIs to work out (all by default), only their tables are parsed")
+    parser.add_argument('-o', '--output-prefix', default='',
+        help="Prefix of the output file names, needed with --kfi so the full outputs are kept")
+    parser.add_argument('-s', '--provider-store', type=pathlib.Path,
+        help="Directory to also write the KFIs to as a memory-mapped store indexed by provider")
+    parser.add_argument('-i', '--incremental', action='store_true',
+        help="Only parse the academic years new since the last run, and append them to its outputs")
+    parser.add_argument('-t', '--trace', type=pathlib.Path,
+        help="JSON file of the time, rows and memory of every stage of every table")
+    parser.add_argument('--chrome-trace', type=pathlib.Path,
+        help="The same stages as a Chrome trace (chrome://tracing, Perfetto)")
+    args = parser.parse_args()
+
+    if args.trace or args.chrome_trace:
+        instrument.enable()
+
+    if args.output_format != 'csv' and pyarrow is None:
+        sys.exit(f"Writing {args.output_format} files needs pyarrow to be installed.")
+
+    try:
+        tables = kfi_tables(args.kfi)
+    except ValueError as err:
+        sys.exit(str(err))
+
+    # a subset of the KFIs (and the tables behind them) is never written over the full outputs
+    if args.kfi and not args.output_prefix:
+        sys.exit("Give an --output-prefix for the tables of a --kfi run.")
+
+    if args.incremental and args.kfi:
+        sys.exit("An incremental ingest appends every KFI, it can't be limited with --kfi.")
+
+    if args.backend == 'arrow' and pyarrow is None:
+        sys.exit("The arrow backend needs pyarrow to be installed.")
+
+    if args.cache_dir:
+        if pyarrow is None:
+            sys.exit("The parsed table cache needs pyarrow to be installed.")
+        args.cache_dir.mkdir(parents=True, exist_ok=True)
+
+    manifest_path = f'{args.output_prefix}{MANIFEST}'
+    if args.incremental:
+        # only the years with a new partition, checking the rest are unchanged
+        tbls, years, parts = new_year_tables(args.jobs, args.cache_dir, args.backend,
+            args.output_format, manifest_path)
+        if not years:
+            print("No new academic years to ingest")
+            return None
+        print(f"Ingesting {', '.join(years)}")
+        try:
+            # CSV values are read back exactly, so the earlier years are rewritten as they were
+            old_wide = read_table(f'{args.output_prefix}wide.{args.output_format}', index_col=0, float_precision='round_trip')
+            old_kfi = read_table(f'{args.output_prefix}kfi.{args.output_format}', float_precision='round_trip')
+        except FileNotFoundError as err:
+            sys.exit(f"{err.filename} from the last ingest is missing, run a full ingest.")
+    else:
+        tbls = parse_tables(jobs=args.jobs, cache_dir=args.cache_dir, backend=args.backend,
+            tables=tables)
+        # only a run of every table can be ingested against later
+        parts = None if args.kfi else source_partitions(dict(zip(CSV_TABLES, tbls)), zip_members(11))
 
     # merge tables vertically
-    long_tbl = pd.concat(tbls, ignore_index=True)
-    LT = long_tbl.astype({'value':'float64'})
+    with instrument.span('concat', rows_in=sum(len(t) for t in tbls)) as s:
+        long_tbl = pd.concat(tbls, ignore_index=True)
+        s['rows_out'] = len(long_tbl)
 
     # pivot table long to wide
-    wide = pd.pivot_table(
-        LT, values=["value"], columns=['category'], 
-        index=["ukprn","he provider","academic year"], fill_value=0)
-    WV = wide['value'].reset_index()
-
-    WV.to_csv('wide.csv')
-
-    # Table of Key Financial Indicators
-    kfi = key_financial_indicators(WV)
-    kfi = kfi.round(3)
-
-    # Get provider group IDs
-    pg = pd.read_csv('./data/provider_groups.csv')
-    pg = pg.rename(str.lower, axis='columns')
-    pg = pg.rename(columns={'provider ukprn':'ukprn'})
-    # add these to KFIs
-    kfi = kfi.join(pg.set_index('ukprn'), on='ukprn', how='inner')
-    kfi.to_csv('kfi.csv', index=False)
+    with instrument.span('pivot', rows_in=len(long_tbl)) as s:
+        try:
+            WV = pivot_wide(long_tbl, duplicates=args.duplicates)
+        except ValueError as err:
+            sys.exit(str(err))
+        s['rows_out'] = len(WV)
+
+    new_rows = slice(None)
+    if args.incremental:
+        with instrument.span('append', table='wide', rows_in=len(WV)) as s:
+            WV = append_years(old_wide, WV, years)
+            # categories either side lacks are 0, as pivot_wide leaves them
+            ids = ['ukprn', 'he provider', 'academic year']
+            categories = sorted(set(WV.columns) - set(ids))
+            WV = pd.concat([WV[ids], WV[categories].fillna(0)], axis=1)
+            WV.columns.name = 'category'
+            new_rows = WV['academic year'].astype(str).isin(years)
+            s['rows_out'] = len(WV)
+
+    # the outputs are about to change, so the last run's manifest no longer
+    # describes them (a new one is written once they all are)
+    pathlib.Path(manifest_path).unlink(missing_ok=True)
+
+    with instrument.span('write', table='wide'):
+        write_table(WV, f'{args.output_prefix}wide', args.output_format)
+
+    # Table of Key Financial Indicators, of the new rows alone when appending
+    with instrument.span('kfi', rows_in=len(WV)) as s:
+        kfi = key_financial_indicators(WV[new_rows], args.kfi)
+        kfi = kfi.round(3)
+        s['rows_out'] = len(kfi)
+
+    # add provider group IDs to KFIs
+    with instrument.span('join', rows_in=len(kfi)) as s:
+        kfi = kfi.join(provider_groups(), on='ukprn', how='inner')
+        s['rows_out'] = len(kfi)
+
+    if args.incremental:
+        with instrument.span('append', table='kfi', rows_in=len(kfi)) as s:
+            kfi = append_years(old_kfi, kfi, years)
+            s['rows_out'] = len(kfi)
+
+    with instrument.span('write', table='kfi'):
+        write_table(kfi, f'{args.output_prefix}kfi', args.output_format, index=False)
+        if args.provider_store:
+            write_store(kfi, args.provider_store)
+
+    # the sector distributions each provider is compared against
+    kfis = args.kfi or list(KFI_FORMULAS)
+    with instrument.span('peer tables', rows_in=len(kfi)):
+        write_table(quantile_cube(kfi, kfis).round(3), f'{args.output_prefix}kfi_quantiles',
+            args.output_format, index=False)
+        write_table(peer_ranks(kfi, kfis).round(1), f'{args.output_prefix}kfi_ranks',
+            args.output_format, index=False)
+
+    if parts is not None:
+        write_manifest(parts, args.output_format, kfis, manifest_path)
+
+    if args.trace:
+        instrument.write_trace(args.trace)
+    if args.chrome_trace:
+        instrument.write_chrome_trace(args.chrome_trace)
 
     return kfi
 
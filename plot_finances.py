@@ -2,210 +2,178 @@
 
 import pandas as pd
 import seaborn as sb
-import matplotlib.pyplot as plt
+import matplotlib
+from matplotlib.figure import Figure
+from concurrent.futures import ProcessPoolExecutor
 import pdb
 import argparse
+import json
 import pathlib
 import sys
-
-def average_salary(tbl, ukprn=10007792, outdir=None, group='russell group filter'):
-    print("\tAnnual average salary for staff in k£")
-
-    # Get details for single uni
-    uni = tbl[tbl['ukprn']==ukprn]
-    name = uni['he provider'].unique()[0]
-
-    avg_salary = sb.swarmplot(
-        data=tbl,
-        x='academic year', y='avg_salary', hue=group,
-        dodge=True, zorder=1, warn_thresh=0.2
-    )
-    sb.lineplot(
-        data=uni, ax=avg_salary,
-        x='academic year', y='avg_salary',
-        color='g', label=name, zorder=2, marker='o', markersize=10
-    )
-    avg_salary.set_ylim(25,65)
-    avg_salary.set(
-        xlabel='Academic Year', 
-        ylabel='Annual Salary (k£)',
-        title='Average UKHE staff salary per year'
-    )
-    plt.legend(loc='upper left', title=group.title())
-    plt.savefig(outdir.joinpath('avg_salary.png'))
-    plt.clf()
-
-def staffcosts_income(tbl, ukprn=10007792, outdir=None, group='russell group filter'):
-    print("\tProportion of Income spent on Staff Costs")
-
-    # Get details for single uni
-    uni = tbl[tbl['ukprn']==ukprn]
-    name = uni['he provider'].unique()[0]
-
-    staff_income = sb.swarmplot(
-        data=tbl,
-        x='academic year', y='staff_vs_income', hue=group,
-        dodge=True, zorder=1, warn_thresh=0.2
-    )
-    sb.lineplot(
-        data=uni, ax=staff_income,
-        x='academic year', y='staff_vs_income',
-        color='g', label=name, zorder=2, marker='o', markersize=10
-    )
-    staff_income.set_ylim(0.1,0.8)
-    staff_income.set(
-        xlabel='Academic Year', 
-        ylabel='Proportion of Total Income',
-        title='What proportion of income is spent on staff costs'
-    )
-    plt.legend(loc='lower left', title=group.title())
-    plt.savefig(outdir.joinpath('staff_vs_income.png'))
-    plt.clf()
-
-def staffcosts_expenditure(tbl, ukprn=10007792, outdir=None, group='russell group filter'):
-    print("\tWhat proportion of Total Expenditure is Staff Costs")
-
-    # Get details for single uni
-    uni = tbl[tbl['ukprn']==ukprn]
-    name = uni['he provider'].unique()[0]
-
-    staff_expend = sb.swarmplot(
-        data=tbl,
-        x='academic year', y='staff_vs_expend', hue=group,
-        dodge=True, zorder=1, warn_thresh=0.2
-    )
-    sb.lineplot(
-        data=uni, ax=staff_expend,
-        x='academic year', y='staff_vs_expend',
-        color='g', label=name, zorder=2, marker='o', markersize=10
-    )
-    staff_expend.set_ylim(0.1,0.8)
-    staff_expend.set(
-        xlabel='Academic Year', 
-        ylabel='Proportion of Total Expenditure',
-        title='What proportion of annual expenditure is staff costs'
-    )
-    plt.legend(loc='lower left', title=group.title())
-    plt.savefig(outdir.joinpath('staff_vs_expend.png'))
-    plt.clf()
-
-def annual_surplus_income(tbl, ukprn=10007792, outdir=None, group='russell group filter'):
-    print("\tHow big is the annual surplus, scaled by the total income")
-
-    # Get details for single uni
-    uni = tbl[tbl['ukprn']==ukprn]
-    name = uni['he provider'].unique()[0]
-
-    surplus_income = sb.swarmplot(
-        data=tbl,
-        x='academic year', y='surplus_vs_income', hue=group,
-        dodge=True, zorder=1, warn_thresh=0.2
-    )
-    sb.lineplot(
-        data=uni, ax=surplus_income,
-        x='academic year', y='surplus_vs_income',
-        color='g', label=name, zorder=2, marker='o', markersize=10
-    )
-    surplus_income.set_ylim(-0.2,0.25)
-    surplus_income.set(
-        xlabel='Academic Year', 
-        ylabel='Proportion of Total Income',
-        title='How big is the annual surplus relative to total income?'
-    )
-    plt.legend(loc='lower left', title=group.title())
-    plt.savefig(outdir.joinpath('surplus_vs_income.png'))
-    plt.clf()
-
-def unrestricted_reserves(tbl, ukprn=10007792, outdir=None, group='russell group filter'):
-    print("\tUnrestricted Reserves, scaled by the total income")
-
-    # Get details for single uni
-    uni = tbl[tbl['ukprn']==ukprn]
-    name = uni['he provider'].unique()[0]
-
-    ax = sb.swarmplot(
-        data=tbl,
-        x='academic year', y='unrestricted_vs_income', hue=group,
-        dodge=True, zorder=2, warn_thresh=0.2
-    )
-    sb.lineplot(
-        data=uni, ax=ax,
-        x='academic year', y='unrestricted_vs_income',
-        color='g', label=name, zorder=3, marker='o', markersize=10
-    )
-    ax.axhline(0.5, label='"reasonable" lowerbound', color='black', linestyle='dashed', zorder=1)
-    ax.set_ylim(-1,5.25)
-    ax.set(
-        xlabel='Academic Year', 
-        ylabel='Proportion of Total Income',
-        title='How big are the Unrestricted Reserves relative to total income?'
-    )
-    plt.legend(loc='upper left', title=group.title())
-    plt.savefig(outdir.joinpath('reserves_vs_income.png'))
-    plt.clf()
-
-def external_borrowing(tbl, ukprn=10007792, outdir=None, group='russell group filter'):
-    print("\tThe scale of external borrowing by year")
-
-    # Get details for single uni
-    uni = tbl[tbl['ukprn']==ukprn]
-    name = uni['he provider'].unique()[0]
-
-    ax = sb.swarmplot(
-        data=tbl,
-        x='academic year', y='ext_borrow_vs_income', hue=group,
-        dodge=True, zorder=2, warn_thresh=0.2
-    )
-    sb.lineplot(
-        data=uni, ax=ax,
-        x='academic year', y='ext_borrow_vs_income',
-        color='g', label=name, zorder=3, marker='o', markersize=10
-    )
-    ax.axhline(0.5, label='"normal" range', color='black', linestyle='dashed', zorder=1)
-    ax.set_ylim(-0.1,2.5)
-    ax.set(
-        xlabel='Academic Year', 
-        ylabel='Proportion of Total Income',
-        title='How much external borrowing does each institution do?'
-    )
-    plt.legend(loc='upper left', title=group.title())
-    plt.savefig(outdir.joinpath('extborrow_vs_income.png'))
-    plt.clf()
-
-def asset_liability_ratio(tbl, ukprn=10007792, outdir=None, group='russell group filter'):
-    print("\tThe ratio of currenet assets to liabilities")
-
-    # Get details for single uni
-    uni = tbl[tbl['ukprn']==ukprn]
-    name = uni['he provider'].unique()[0]
-
-    ax = sb.swarmplot(
-        data=tbl,
-        x='academic year', y='current_assets_vs_liability', hue=group,
-        dodge=True, zorder=2, warn_thresh=0.2
-    )
-    sb.lineplot(
-        data=uni, ax=ax,
-        x='academic year', y='current_assets_vs_liability',
-        color='g', label=name, zorder=3, marker='o', markersize=10
-    )
-    ax.axhline(1, label='"good" lowerbound', color='black', linestyle='dashed', zorder=1)
-    ax.set_ylim(-0.1,10)
+import time
+
+from merge_data import read_table
+from swarm_layout import swarm_sector, cached_swarm_positions
+
+def new_axes():
+    # explicit figures instead of pyplot's global state, so that each figure
+    # can be drawn in its own worker process
+    return Figure().subplots()
+
+def swarmplot(ax, tbl, y, sector, ylim, zorder=1, cache_dir=None, dodge=True):
+    # dodged swarm of every provider per year, drawn with plain scatter from a
+    # precomputed (and optionally cached) layout
+    ax.set_ylim(*ylim)
+    bbox = ax.get_window_extent()
+    axes_pt = (bbox.width*72/ax.figure.dpi, bbox.height*72/ax.figure.dpi)
+    values = tbl[y].to_numpy(dtype='float64')
+    if dodge:
+        pos = cached_swarm_positions(values, sector, ylim, axes_pt, cache_dir=cache_dir, name=y)
+    else:
+        # previews skip the layout and stack every point on its year
+        pos = sector['x'].astype('float64')
+
+    for j, (colour, group) in enumerate(zip(sb.color_palette(), sector['groups'])):
+        rows = sector['hue'] == j
+        ax.scatter(pos[rows], values[rows], s=25, linewidth=0, color=colour,
+            label=group, zorder=zorder)
+
+    years = sector['years']
+    ax.set_xticks(range(len(years)), years)
+    ax.set_xlim(-0.5, len(years) - 0.5)
+    ax.xaxis.grid(False)
+
+def year_line(ax, years, uni, y, name, zorder=2):
+    # a provider's history drawn over the swarm's year positions
+    line = pd.DataFrame({'x': uni['academic year'].map(years.index), 'y': uni[y]})
+    line = line.sort_values('x').dropna()
+    ax.plot(line['x'], line['y'], color='g', label=name, zorder=zorder,
+        marker='o', markersize=10)
+
+def save_highlights(ax, providers, fname, highlight, **legend):
+    # the sector background is already drawn, so for each provider only its
+    # highlight is drawn on top, saved and then removed again.
+    # Returns the seconds spent rendering and encoding the files.
+    fname = pathlib.Path(fname).with_suffix('.' + matplotlib.rcParams['savefig.format'])
+    encode = 0.0
+    for ukprn, (uni, outdir) in providers.items():
+        name = uni['he provider'].unique()[0]
+        background = set(ax.get_children())
+
+        highlight(ukprn, uni, name)
+        ax.legend(**legend)
+        start = time.perf_counter()
+        ax.figure.savefig(outdir.joinpath(fname))
+        encode += time.perf_counter() - start
+
+        for artist in set(ax.get_children()) - background:
+            artist.remove()
+    return encode
+
+# sector swarm plots of a single KFI per year, with the provider's history on top
+SWARM_SPECS = [
+    {'y': 'net_liquidity_days', 'fname': 'net_liquidity_days.png',
+        'message': "Net Liquidity Days",
+        'ylim': (-10,600), 'ylabel': 'Days of Operating Cost Coverage',
+        'title': 'A measure of institutions abilitity to costs from liquid assets',
+        'threshold': (60, 'Lower Bound'), 'loc': 'upper left'},
+    {'y': 'ops_cash_vs_income', 'fname': 'opscash_vs_income.png',
+        'message': "Net cash flow",
+        'ylim': (-0.2,0.425), 'ylabel': 'Proportion of Total Income',
+        'title': 'What is the net cash flow from Operating Actives relative to income?',
+        'threshold': (0.05, '"alright" lowerbound'), 'loc': 'upper left'},
+    {'y': 'vc_avg_remunerate', 'fname': 'vc_compensation.png',
+        'message': "Ratio of VC remuneration to that average remuneration of staff.",
+        'ylim': (0,14), 'ylabel': 'Ratio of VC to staff average',
+        'title': "How does the VC's remuneration compare to the rest of staff?",
+        'loc': 'lower left'},
+    {'y': 'capital_vs_expend', 'fname': 'capital_expenditure.png',
+        'message': "How of total expenditures is spent on capital projects",
+        'ylim': (0,0.8), 'ylabel': 'Proportion of annual Total Expenditure',
+        'title': 'What proportion of annual expenditure is on Capital Costs?',
+        'loc': 'upper center'},
+    {'y': 'staff_vs_income', 'fname': 'staff_vs_income.png',
+        'message': "Proportion of Income spent on Staff Costs",
+        'ylim': (0.1,0.8), 'ylabel': 'Proportion of Total Income',
+        'title': 'What proportion of income is spent on staff costs',
+        'loc': 'lower left'},
+    {'y': 'staff_vs_expend', 'fname': 'staff_vs_expend.png',
+        'message': "What proportion of Total Expenditure is Staff Costs",
+        'ylim': (0.1,0.8), 'ylabel': 'Proportion of Total Expenditure',
+        'title': 'What proportion of annual expenditure is staff costs',
+        'loc': 'lower left'},
+    {'y': 'avg_salary', 'fname': 'avg_salary.png',
+        'message': "Annual average salary for staff in k£",
+        'ylim': (25,65), 'ylabel': 'Annual Salary (k£)',
+        'title': 'Average UKHE staff salary per year',
+        'loc': 'upper left'},
+    {'y': 'surplus_vs_income', 'fname': 'surplus_vs_income.png',
+        'message': "How big is the annual surplus, scaled by the total income",
+        'ylim': (-0.2,0.25), 'ylabel': 'Proportion of Total Income',
+        'title': 'How big is the annual surplus relative to total income?',
+        'loc': 'lower left'},
+    {'y': 'unrestricted_vs_income', 'fname': 'reserves_vs_income.png',
+        'message': "Unrestricted Reserves, scaled by the total income",
+        'ylim': (-1,5.25), 'ylabel': 'Proportion of Total Income',
+        'title': 'How big are the Unrestricted Reserves relative to total income?',
+        'threshold': (0.5, '"reasonable" lowerbound'), 'loc': 'upper left'},
+    {'y': 'ext_borrow_vs_income', 'fname': 'extborrow_vs_income.png',
+        'message': "The scale of external borrowing by year",
+        'ylim': (-0.1,2.5), 'ylabel': 'Proportion of Total Income',
+        'title': 'How much external borrowing does each institution do?',
+        'threshold': (0.5, '"normal" range'), 'loc': 'upper left'},
+    {'y': 'current_assets_vs_liability', 'fname': 'asset_vs_liabilities.png',
+        'message': "The ratio of currenet assets to liabilities",
+        'ylim': (-0.1,10), 'ylabel': 'Ratio of assets to liabilities',
+        'title': 'Measure of ability to pay near future debts from "liquid" assets.',
+        'threshold': (1, '"good" lowerbound'), 'loc': 'upper left'},
+]
+
+# keys every swarm spec needs, 'threshold' is optional
+SWARM_SPEC_KEYS = ['y', 'fname', 'message', 'ylim', 'ylabel', 'title', 'loc']
+
+def render_swarm(tbl, providers, spec, sector=None, group='russell group filter', cache_dir=None, dodge=True):
+    print("\t" + spec['message'])
+    if sector is None:
+        sector = swarm_sector(tbl, group)
+
+    ax = new_axes()
+    # a threshold line is drawn beneath the swarm
+    threshold = spec.get('threshold')
+    zorder = 2 if threshold else 1
+    swarmplot(ax, tbl, spec['y'], sector, spec['ylim'], zorder=zorder, cache_dir=cache_dir,
+        dodge=dodge)
+    if threshold:
+        ax.axhline(threshold[0], label=threshold[1], color='black', linestyle='dashed', zorder=1)
     ax.set(
-        xlabel='Academic Year', 
-        ylabel='Ratio of assets to liabilities',
-        title='Measure of ability to pay near future debts from "liquid" assets.'
-    )
-    plt.legend(loc='upper left', title=group.title())
-    plt.savefig(outdir.joinpath('asset_vs_liabilities.png'))
-    plt.clf()
-
-def change_tuition_fees(tbl, ukprn=10007792, outdir=None, group='russell group filter'):
-    # Get details for single uni
-    uni_name = tbl.loc[tbl['ukprn']==ukprn, 'he provider'].unique()[0]
-
+        xlabel='Academic Year',
+        ylabel=spec['ylabel'],
+        title=spec['title']
+    )
+
+    def highlight(ukprn, uni, name):
+        year_line(ax, sector['years'], uni, spec['y'], name, zorder=zorder+1)
+    return save_highlights(ax, providers, spec['fname'], highlight,
+        loc=spec['loc'], title=group.title())
+
+def load_swarm_specs(spec_file, columns):
+    # extra (or replacement, by file name) swarm plots declared in a JSON list,
+    # checked up front so a bad spec doesn't fail half way through (or in a worker)
+    specs = {spec['fname']: spec for spec in SWARM_SPECS}
+    for i, spec in enumerate(json.load(spec_file)):
+        missing = [key for key in SWARM_SPEC_KEYS if key not in spec]
+        if missing:
+            sys.exit(f"Swarm spec {i} in <{spec_file.name}> is missing {', '.join(missing)}.")
+        if spec['y'] not in columns:
+            sys.exit(f"Swarm spec {spec['fname']} plots {spec['y']}, which is not in the KFI table.")
+        specs[spec['fname']] = spec
+    return list(specs.values())
+
+def change_tuition_fees(tbl, providers, group='russell group filter'):
     # rescale tuition fees from 2016/17 value to compare growth levels
-    w = pd.pivot_table(tbl, values=['tuition_fees'], columns=['academic year'], index=['ukprn','russell group filter'])
+    w = pd.pivot_table(
+        tbl, values=['tuition_fees'], columns=['academic year'],
+        index=['ukprn','russell group filter'], observed=True)
     norm = w.div(w[('tuition_fees','2016/17')], axis=0, level=1)
     L = norm.stack()
     L.reset_index()
@@ -213,312 +181,289 @@ def change_tuition_fees(tbl, ukprn=10007792, outdir=None, group='russell group f
     pct = pct.mul({'tuition_fees': 100})
 
     print("\tGauging how tuition fees changes over time for each institution")
-    tuition_fees = sb.lineplot(
-        data=pct,
+    tuition_fees = new_axes()
+    sb.lineplot(
+        data=pct, ax=tuition_fees,
         x='academic year', y='tuition_fees', hue=group,
         alpha=0.6, estimator=None, units='ukprn', lw=3, zorder=1
     )
-    sb.scatterplot(
-        data=pct.loc[ukprn], ax=tuition_fees,
-        x='academic year', y='tuition_fees',
-        color='g', s=200, label=uni_name, zorder=2
-    )
     tuition_fees.set_ylim(-25,150)
     tuition_fees.set(
-        xlabel='Academic Year', 
+        xlabel='Academic Year',
         ylabel='Percent change in tuition fee income',
         title='How has UKHE income from tuition fees changed over time?'
     )
-    plt.legend(loc='upper left', title=group.title())
-    plt.savefig(outdir.joinpath('total_tuition_fees.png'))
-    plt.clf()
 
-def tuition_vs_surplus(tbl, ukprn=10007792, outdir=None, group='russell group filter', year='2021/22'):
+    def highlight(ukprn, uni, name):
+        sb.scatterplot(
+            data=pct.loc[ukprn], ax=tuition_fees,
+            x='academic year', y='tuition_fees',
+            color='g', s=200, label=name, zorder=2
+        )
+    return save_highlights(tuition_fees, providers, 'total_tuition_fees.png', highlight,
+        loc='upper left', title=group.title())
+
+def tuition_vs_surplus(tbl, providers, group='russell group filter', year='2021/22'):
     print("\tThe relationship between tuition fee income and annual surplus")
 
-    # Get data for a single year    
+    # Get data for a single year
     tbl_yr = tbl[ tbl['academic year']==year ]
-    # Get details for single uni
-    uni = tbl_yr[ tbl_yr['ukprn']==ukprn ]
-    name = uni['he provider'].unique()[0]
 
-    fee_income = sb.scatterplot(
-        data=tbl_yr, 
+    fee_income = new_axes()
+    sb.scatterplot(
+        data=tbl_yr, ax=fee_income,
         x='surplus_vs_income', y='total_fees_vs_income', hue=group,
-        zorder=1, legend=True, alpha=0.6, 
+        zorder=1, legend=True, alpha=0.6,
         size=tbl_yr['uk_vs_total_fees']*100
     )
-    sb.scatterplot(
-        data=uni, ax=fee_income,
-        x='surplus_vs_income', y='total_fees_vs_income',
-        color='g', size=100, zorder=2, label=name, legend=False
-    )
     fee_income.set_xlim(-0.2,0.5)
     fee_income.set_ylim(-0.01,1)
     fee_income.set(
-        xlabel='Total annual surplus relative to Total income', 
-        ylabel='Proportion of income from student fees', 
+        xlabel='Total annual surplus relative to Total income',
+        ylabel='Proportion of income from student fees',
         title=f'Relationship beween fee income and annual surplus in {year}'
     )
-    plt.legend(loc='upper right')
-    plt.savefig(outdir.joinpath('fees_vs_surplus.png'))
-    plt.clf()
 
-def tuition_fee_proportion(tbl, ukprn=10007792, outdir=None, group='russell group filter'):
-    print("\tUnderstand what portion of income comes from Student Fees")
+    def highlight(ukprn, uni, name):
+        sb.scatterplot(
+            data=uni[ uni['academic year']==year ], ax=fee_income,
+            x='surplus_vs_income', y='total_fees_vs_income',
+            color='g', size=100, zorder=2, label=name, legend=False
+        )
+    return save_highlights(fee_income, providers, 'fees_vs_surplus.png', highlight,
+        loc='upper right')
 
-    # Get details for single uni
-    uni = tbl[tbl['ukprn']==ukprn]
-    name = uni['he provider'].unique()[0]
+def tuition_fee_proportion(tbl, providers, group='russell group filter'):
+    print("\tUnderstand what portion of income comes from Student Fees")
 
-    fee_income = sb.scatterplot(
-        data=tbl[ tbl['academic year']=='2021/22' ], 
+    fee_income = new_axes()
+    sb.scatterplot(
+        data=tbl[ tbl['academic year']=='2021/22' ], ax=fee_income,
         x='total_fees_vs_income', y='uk_vs_total_fees', hue=group,
         zorder=1, legend=True
     )
-    sb.scatterplot(
-        data=uni[ uni['academic year']=='2021/22' ], ax=fee_income,
-        x='total_fees_vs_income', y='uk_vs_total_fees',
-        color='g', s=200, label=name, zorder=2
-    )
     fee_income.set_xlim(0,1)
     fee_income.set_ylim(0,1)
     fee_income.set(
-        xlabel='Proportion of income from student fees', 
+        xlabel='Proportion of income from student fees',
         ylabel='Proportion of fee income from UK students',
         title='Contribution of student fees to UKHE income in 2021/22'
     )
-    plt.legend(loc='lower right', title=group.title())
-    plt.savefig(outdir.joinpath('fees_vs_income.png'))
-    plt.clf()
-
-def capital_projects(tbl, ukprn=10007792, outdir=None, group='russell group filter'):
-    print("\tHow of total expenditures is spent on capital projects")
-
-    # Get details for single uni
-    uni = tbl[tbl['ukprn']==ukprn]
-    name = uni['he provider'].unique()[0]
-
-    capital_expend = sb.swarmplot(
-        data=tbl,
-        x='academic year', y='capital_vs_expend', hue=group,
-        dodge=True, zorder=1, warn_thresh=0.2
-    )
-    sb.lineplot(
-        data=uni, ax=capital_expend,
-        x='academic year', y='capital_vs_expend',
-        color='g', label=name, zorder=2, marker='o', markersize=10
-    )
-    capital_expend.set_ylim(0,0.8)
-    capital_expend.set(
-        xlabel='Academic Year', 
-        ylabel='Proportion of annual Total Expenditure',
-        title='What proportion of annual expenditure is on Capital Costs?'
-    )
-    plt.legend(loc='upper center', title=group.title())
-    plt.savefig(outdir.joinpath('capital_expenditure.png'))
-    plt.clf()
 
-def galt_index(tbl, ukprn=10007792, outdir=None, group='russell group filter'):
-    print("\tRatio of VC remuneration to that average remuneration of staff.")
+    def highlight(ukprn, uni, name):
+        sb.scatterplot(
+            data=uni[ uni['academic year']=='2021/22' ], ax=fee_income,
+            x='total_fees_vs_income', y='uk_vs_total_fees',
+            color='g', s=200, label=name, zorder=2
+        )
+    return save_highlights(fee_income, providers, 'fees_vs_income.png', highlight,
+        loc='lower right', title=group.title())
 
-    # Get details for single uni
-    uni = tbl[tbl['ukprn']==ukprn]
-    name = uni['he provider'].unique()[0]
-
-    vc = sb.swarmplot(
-        data=tbl,
-        x='academic year', y='vc_avg_remunerate', hue=group,
-        dodge=True, zorder=1, warn_thresh=0.2
-    )
-    sb.lineplot(
-        data=uni, ax=vc,
-        x='academic year', y='vc_avg_remunerate',
-        color='g', label=name, zorder=2, marker='o', markersize=10
-    )
-    vc.set_ylim(0,14)
-    vc.set(
-        xlabel='Academic Year', 
-        ylabel='Ratio of VC to staff average',
-        title="How does the VC's remuneration compare to the rest of staff?"
-    )
-    plt.legend(loc='lower left', title=group.title())
-    plt.savefig(outdir.joinpath('vc_compensation.png'))
-    plt.clf()
 
 
-def compare_staff_salary(tbl, acyear='2021/22', ukprn=10007792, outdir=None, group='russell group filter'):
+def compare_staff_salary(tbl, providers, acyear='2021/22', group='russell group filter'):
     print("\tComparing average salaries for academics and ps-staff")
 
-    # Get details for single uni
-    uni = tbl[tbl['ukprn']==ukprn]
-    name = uni['he provider'].unique()[0]
-
-    ax = sb.scatterplot(
-        data=tbl[tbl['academic year']==acyear], 
+    ax = new_axes()
+    sb.scatterplot(
+        data=tbl[tbl['academic year']==acyear], ax=ax,
         x='academic_salary', y='ps_staff_salary', hue=group,
         zorder=2, legend=True
     )
-    sb.scatterplot(
-        data=uni[ uni['academic year']==acyear ], ax=ax,
-        x='academic_salary', y='ps_staff_salary',
-        color='g', s=200, label=name, zorder=3
-    )
     ax.set_ylim(20,80)
     ax.set_xlim(20,80)
     ax.set(
-        xlabel='Average Salary (k£) for Academic Staff', 
+        xlabel='Average Salary (k£) for Academic Staff',
         ylabel='Average Salary (k£) for Professional Services',
         title='Comparing Salaries between Academic and PS Staff for '+acyear
     )
-    plt.plot(
+    ax.plot(
         [20, 80], [20, 80], zorder=1,
         color='black', linestyle='dashed', linewidth=2, label='Equality'
     )
-    plt.legend(loc='upper right', title=group.title())
-    plt.savefig(outdir.joinpath('compare_salaries.png'))
-    plt.clf()
-
-def net_liquidity_days(tbl, ukprn=10007792, outdir=None, group='russell group filter'):
-    print("\tNet Liquidity Days")
-
-    # Get details for single uni
-    uni = tbl[tbl['ukprn']==ukprn]
-    name = uni['he provider'].unique()[0]
-
-    surplus_income = sb.swarmplot(
-        data=tbl,
-        x='academic year', y='net_liquidity_days', hue=group,
-        dodge=True, zorder=1, warn_thresh=0.2
-    )
-    sb.lineplot(
-        data=uni, ax=surplus_income,
-        x='academic year', y='net_liquidity_days',
-        color='g', label=name, zorder=2, marker='o', markersize=10
-    )
-    surplus_income.axhline(60, label='Lower Bound', color='black', linestyle='dashed')
-    surplus_income.set_ylim(-10,600)
-    surplus_income.set(
-        xlabel='Academic Year', 
-        ylabel='Days of Operating Cost Coverage',
-        title='A measure of institutions abilitity to costs from liquid assets'
-    )
-    plt.legend(loc='upper left', title=group.title())
-    plt.savefig(outdir.joinpath('net_liquidity_days.png'))
-    plt.clf()
 
-def operating_cash_flow(tbl, ukprn=10007792, outdir=None, group='russell group filter'):
-    print("\tNet cash flow")
-
-    # Get details for single uni
-    uni = tbl[tbl['ukprn']==ukprn]
-    name = uni['he provider'].unique()[0]
-
-    ax = sb.swarmplot(
-        data=tbl,
-        x='academic year', y='ops_cash_vs_income', hue=group,
-        dodge=True, zorder=1, warn_thresh=0.2
-    )
-    sb.lineplot(
-        data=uni, ax=ax,
-        x='academic year', y='ops_cash_vs_income',
-        color='g', label=name, zorder=2, marker='o', markersize=10
-    )
-    ax.axhline(0.05, label='"alright" lowerbound', color='black', linestyle='dashed', zorder=1)
-    ax.set_ylim(-0.2,0.425)
-    ax.set(
-        xlabel='Academic Year', 
-        ylabel='Proportion of Total Income',
-        title='What is the net cash flow from Operating Actives relative to income?'
-    )
-    plt.legend(loc='upper left', title=group.title())
-    plt.savefig(outdir.joinpath('opscash_vs_income.png'))
-    plt.clf()
+    def highlight(ukprn, uni, name):
+        sb.scatterplot(
+            data=uni[ uni['academic year']==acyear ], ax=ax,
+            x='academic_salary', y='ps_staff_salary',
+            color='g', s=200, label=name, zorder=3
+        )
+    return save_highlights(ax, providers, 'compare_salaries.png', highlight,
+        loc='upper right', title=group.title())
 
-def comparing_surplus_measures(tbl, acyear='2021/22', ukprn=10007792, outdir=None, group='russell group filter'):
+def comparing_surplus_measures(tbl, providers, acyear='2021/22', group='russell group filter'):
     print("\tAnnual surplus measures for "+acyear)
 
-    # Get details for single uni
-    uni = tbl[tbl['ukprn']==ukprn]
-    name = uni['he provider'].unique()[0]
-
-    ax = sb.scatterplot(
-        data=tbl[tbl['academic year']==acyear], 
+    ax = new_axes()
+    sb.scatterplot(
+        data=tbl[tbl['academic year']==acyear], ax=ax,
         x='ops_cash_vs_income', y='surplus_vs_income', hue=group,
         zorder=3, legend=True
     )
-    sb.scatterplot(
-        data=uni[ uni['academic year']==acyear ], ax=ax,
-        x='ops_cash_vs_income', y='surplus_vs_income',
-        color='g', s=200, label=name, zorder=4
-    )
     ax.axhline(0, color='black', linestyle='dashed', zorder=1)
     ax.axvline(0.05, color='black', linestyle='dotted', zorder=2)
     ax.set_xlim(-0.2,0.425)
     ax.set_ylim(-0.2,0.25)
     ax.set(
-        xlabel='Net cash flow from operating activities', 
+        xlabel='Net cash flow from operating activities',
         ylabel='Total annual surplus',
         title='Financial surplus measures relative to total income in '+acyear,
     )
-    plt.legend(loc='lower right', title=group.title())
-    plt.savefig(outdir.joinpath('compare_surplus.png'))
-    plt.clf()
 
+    def highlight(ukprn, uni, name):
+        sb.scatterplot(
+            data=uni[ uni['academic year']==acyear ], ax=ax,
+            x='ops_cash_vs_income', y='surplus_vs_income',
+            color='g', s=200, label=name, zorder=4
+        )
+    return save_highlights(ax, providers, 'compare_surplus.png', highlight,
+        loc='lower right', title=group.title())
+
+
+SCATTER_FIGURES = [
+    compare_staff_salary, comparing_surplus_measures, tuition_fee_proportion,
+    tuition_vs_surplus]
+LINE_FIGURES = [change_tuition_fees]
+
+# output settings: 'print' is the full resolution PNG, 'preview' a quick low
+# resolution render with no swarm layout, and 'svg'/'pdf' vector files
+PROFILES = {
+    'print': {'dpi': 300, 'format': 'png', 'dodge': True},
+    'preview': {'dpi': 40, 'format': 'png', 'dodge': False},
+    'svg': {'dpi': 300, 'format': 'svg', 'dodge': True},
+    'pdf': {'dpi': 300, 'format': 'pdf', 'dodge': True},
+}
+
+def set_theme(profile='print'):
+    settings = PROFILES[profile]
+    sb.set_theme(
+        context="talk",
+        style="whitegrid",
+        rc={"figure.figsize":(16, 9), "figure.dpi":settings['dpi'],
+            "savefig.dpi":settings['dpi'], "savefig.format":settings['format']}
+    )
+
+def init_worker(profile='print'):
+    # workers only ever render off-screen with the same figure settings
+    matplotlib.use('Agg')
+    set_theme(profile)
+
+def timed_figure(fn, tbl, providers, kwargs):
+    # seconds spent on the whole figure, and on rendering/encoding its files
+    start = time.perf_counter()
+    encode = fn(tbl, providers, **kwargs)
+    return time.perf_counter() - start, encode
+
+def render_figures(figures, tbl, providers, jobs=1, profile='print'):
+    if jobs > 1:
+        # each figure is drawn and encoded in its own worker process
+        with ProcessPoolExecutor(max_workers=jobs, initializer=init_worker,
+                initargs=(profile,)) as pool:
+            futures = [pool.submit(timed_figure, fn, tbl, providers, kwargs)
+                for name, fn, kwargs in figures]
+            times = [f.result() for f in futures]
+    else:
+        times = [timed_figure(fn, tbl, providers, kwargs) for name, fn, kwargs in figures]
+    return {name: t for (name, fn, kwargs), t in zip(figures, times)}
+
+def timing_report(timings):
+    # layout is everything before the files are written: data wrangling,
+    # artists and the swarm layouts
+    print(f"{'figure':<30} {'layout (s)':>10} {'encode (s)':>10}")
+    for name, (total, encode) in timings.items():
+        print(f"{name:<30} {total - encode:>10.2f} {encode:>10.2f}")
+    total = sum(t for t, e in timings.values())
+    encode = sum(e for t, e in timings.values())
+    print(f"{'total':<30} {total - encode:>10.2f} {encode:>10.2f}")
+
+def ukprn_arg(value):
+    # a UK Provider Number, or 'all'
+    if value == 'all':
+        return value
+    try:
+        return int(value)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"{value} is not a UK Provider Number or 'all'")
+
+def read_ukprns(ukprn_file):
+    # one UK Provider Number per line, blank lines are skipped
+    ukprns = []
+    for line in ukprn_file:
+        if not line.strip():
+            continue
+        try:
+            ukprns.append(int(line))
+        except ValueError:
+            sys.exit(f"{line.strip()} in <{ukprn_file.name}> is not a valid UK Provider Number.")
+    return ukprns
 
 def main():
     parser = argparse.ArgumentParser()
-    parser.add_argument('-i', '--input-csv', type=argparse.FileType('r'), 
-        help="Path to CSV data that the plots are generated from")
+    parser.add_argument('-i', '--input-csv', type=pathlib.Path,
+        help="Path to the KFI data (CSV, Parquet or Feather) that the plots are generated from")
     parser.add_argument('-f', '--figure-dir', type=pathlib.Path,
         help="The directory path where the figures should be saved")
-    parser.add_argument('-u', '--ukprn', type=int, default=10007792,
-        help="The UK PRovider Number for the institution of interest")
-    args = parser.parse_args() 
-
-    # Key Financial Indicators CSV file
-    tbl = pd.read_csv(args.input_csv)
+    parser.add_argument('-u', '--ukprn', type=ukprn_arg, default=10007792,
+        help="The UK PRovider Number for the institution of interest, or 'all' for every provider")
+    parser.add_argument('--ukprn-file', type=argparse.FileType('r'),
+        help="File of UK Provider Numbers, one per line, to plot in a single pass")
+    parser.add_argument('--swarm-cache', type=pathlib.Path,
+        help="Directory where the swarm plot layouts are cached between runs")
+    parser.add_argument('--swarm-specs', type=argparse.FileType('r'),
+        help="JSON list of extra swarm plot specs (as in SWARM_SPECS)")
+    parser.add_argument('-j', '--jobs', type=int, default=1,
+        help="Number of processes the figures are rendered across")
+    parser.add_argument('-p', '--profile', choices=PROFILES, default='print',
+        help="Render profile: full resolution PNGs, quick low resolution previews, or SVG/PDF")
+    parser.add_argument('--timing', action='store_true',
+        help="Report the time spent laying out and encoding each figure")
+    args = parser.parse_args()
+
+    # Key Financial Indicators file
+    tbl = read_table(args.input_csv)
 
     # Checking input arguments
     if not args.figure_dir.exists():
         sys.exit(f"The dir <{args.figure_dir}> does not exist.")
-    if args.ukprn not in tbl['ukprn'].values:
-        sys.exit(f"{args.ukprn} is not a valid UK Provider Number.")
+    if args.ukprn_file:
+        ukprns = read_ukprns(args.ukprn_file)
+    elif args.ukprn == 'all':
+        ukprns = [int(u) for u in tbl['ukprn'].unique()]
     else:
-        uni = tbl.loc[tbl['ukprn']==args.ukprn, 'he provider'].unique()[0]
-        print(f"{args.ukprn} corresponds to {uni}")
+        ukprns = [args.ukprn]
+    invalid = [str(u) for u in ukprns if u not in tbl['ukprn'].values]
+    if invalid:
+        sys.exit(f"{', '.join(invalid)} is not a valid UK Provider Number.")
+
+    # each provider's rows, split out once, and where its figures are saved
+    # (a sub-directory per provider when plotting more than one)
+    rows = dict(tuple(tbl.groupby('ukprn')))
+    providers = {}
+    for ukprn in ukprns:
+        uni = rows[ukprn]
+        print(f"{ukprn} corresponds to {uni['he provider'].unique()[0]}")
+        outdir = args.figure_dir
+        if len(ukprns) > 1:
+            outdir = outdir.joinpath(str(ukprn))
+            outdir.mkdir(exist_ok=True)
+        providers[ukprn] = (uni, outdir)
 
     # Figure settings
-    sb.set_theme(
-        context="talk",
-        style="whitegrid",
-        rc={"figure.figsize":(16, 9), "figure.dpi":300, "savefig.dpi":300}
-    )
-
-    print('Swarm Plots')
-    net_liquidity_days(tbl, ukprn=args.ukprn, outdir=args.figure_dir)
-    operating_cash_flow(tbl, ukprn=args.ukprn, outdir=args.figure_dir)
-    galt_index(tbl, ukprn=args.ukprn, outdir=args.figure_dir)
-    capital_projects(tbl, ukprn=args.ukprn, outdir=args.figure_dir)
-    staffcosts_income(tbl, ukprn=args.ukprn, outdir=args.figure_dir)
-    staffcosts_expenditure(tbl, ukprn=args.ukprn, outdir=args.figure_dir)
-    average_salary(tbl, ukprn=args.ukprn, outdir=args.figure_dir)
-    annual_surplus_income(tbl, ukprn=args.ukprn, outdir=args.figure_dir)
-    unrestricted_reserves(tbl, ukprn=args.ukprn, outdir=args.figure_dir)
-    external_borrowing(tbl, ukprn=args.ukprn, outdir=args.figure_dir)
-    asset_liability_ratio(tbl, ukprn=args.ukprn, outdir=args.figure_dir)
-
-    print('Scatter Plots')
-    compare_staff_salary(tbl, ukprn=args.ukprn, outdir=args.figure_dir)
-    comparing_surplus_measures(tbl, ukprn=args.ukprn, outdir=args.figure_dir)
-    tuition_fee_proportion(tbl, ukprn=args.ukprn, outdir=args.figure_dir)
-    tuition_vs_surplus(tbl, ukprn=args.ukprn, outdir=args.figure_dir)
-
-    print('Line Plots') 
-    change_tuition_fees(tbl, ukprn=args.ukprn, outdir=args.figure_dir)
+    set_theme(args.profile)
+
+    # the sector is split into years and groups once, for every swarm plot
+    specs = load_swarm_specs(args.swarm_specs, tbl.columns) if args.swarm_specs else SWARM_SPECS
+    sector = swarm_sector(tbl, 'russell group filter')
+    dodge = PROFILES[args.profile]['dodge']
+    figures = [
+        (spec['y'], render_swarm,
+            {'spec': spec, 'sector': sector, 'cache_dir': args.swarm_cache, 'dodge': dodge})
+        for spec in specs
+    ]
+    figures += [(fn.__name__, fn, {}) for fn in SCATTER_FIGURES + LINE_FIGURES]
+    timings = render_figures(figures, tbl, providers, jobs=args.jobs, profile=args.profile)
+    if args.timing:
+        timing_report(timings)
 
 if __name__ == "__main__":
     main()
-
-
-
@@ -0,0 +1,166 @@
+#!/usr/bin/python3
+
+import pandas as pd
+import numpy as np
+import argparse
+import itertools
+import json
+import pathlib
+import sys
+
+from merge_data import (KFI_INPUTS, KFI_FORMULAS, evaluate, kfi_engine, kfi_plan,
+    read_table, write_table)
+
+# KFIs which are a wide table category as is, so growth can be given for
+# e.g. 'tuition_fees' as well as 'he_fees'
+INPUT_ALIASES = {name: expr for name, expr in KFI_FORMULAS.items() if expr in KFI_INPUTS}
+
+# totals follow the change in their projected components, in this order. A
+# growth rate given for a total applies to the rest of it. Balances (reserves,
+# cash, creditors...) stay at their base year values unless given a rate.
+PROJECTION_LINKS = {
+    'income': 'income + delta_he_fees + delta_fbg + delta_research + delta_donations + delta_residences',
+    'total_expend': 'total_expend + delta_staff_costs + delta_finance_costs + delta_depreciate_amort',
+    'surplus': 'surplus + delta_income - delta_total_expend',
+}
+
+def apply_links(env, base, links=PROJECTION_LINKS):
+    # recompute the linked totals of env, and their change from base, in order
+    with np.errstate(invalid='ignore'):
+        for name, expr in links.items():
+            env[name] = evaluate(expr, env)
+            env[f"delta_{name}"] = env[name] - base[name]
+    return env
+
+def base_inputs(wide, year=None):
+    # every provider's KFI inputs in the base year (the latest by default)
+    if year is None:
+        year = wide['academic year'].max()
+    base = wide[wide['academic year'] == year].reset_index(drop=True)
+    if base.empty:
+        raise ValueError(f"No providers in the base year <{year}>")
+    arrays = {name: base[col].to_numpy(dtype='float64') for name, col in KFI_INPUTS.items()}
+    return base[['ukprn', 'he provider']], arrays, year
+
+def future_years(year, horizon):
+    # the academic years after the base year, as HESA labels them
+    start = int(year[:4])
+    return [f"{y}/{(y+1) % 100:02d}" for y in range(start + 1, start + horizon + 1)]
+
+def project(base, scenarios, horizon=5, indicators=None):
+    # KFIs of every (scenario, provider, year) as (S x P x H) arrays, where
+    # scenarios holds the annual growth rate of each input (columns) for each
+    # scenario (rows), and unlisted inputs stay flat
+    scenarios = scenarios.rename(columns=INPUT_ALIASES)
+    unknown = [name for name in scenarios.columns if name not in KFI_INPUTS]
+    if unknown:
+        raise ValueError(f"Unknown inputs: {', '.join(unknown)}")
+    if indicators is None:
+        indicators = list(KFI_FORMULAS)
+    inputs, _ = kfi_plan(indicators)
+
+    # compounded growth factor of each input for each scenario and year
+    years = np.arange(1, horizon + 1)
+    flat = {name: array[None, :, None] for name, array in base.items()}
+    env = {}
+    for name in base:
+        if name in scenarios.columns:
+            rates = scenarios[name].to_numpy(dtype='float64')
+            env[name] = flat[name] * (1 + rates[:, None, None]) ** years[None, None, :]
+        else:
+            env[name] = flat[name]
+        env[f"delta_{name}"] = env[name] - flat[name]
+
+    # keep the totals in step with their components
+    apply_links(env, flat)
+
+    shape = (len(scenarios), len(next(iter(base.values()))), horizon)
+    results = kfi_engine({name: env[name] for name in inputs}, indicators)
+    return {name: np.broadcast_to(result, shape) for name, result in results.items()}
+
+def projection_table(results, providers, scenarios, years):
+    # long table of the projected KFIs: one row per scenario, provider and year
+    S, P, H = next(iter(results.values())).shape
+    cols = {
+        'scenario': np.repeat(scenarios.index.to_numpy(), P * H),
+        'ukprn': np.tile(np.repeat(providers['ukprn'].to_numpy(), H), S),
+        'he provider': np.tile(np.repeat(providers['he provider'].to_numpy(), H), S),
+        'academic year': np.tile(years, S * P),
+    }
+    cols.update({name: result.reshape(-1) for name, result in results.items()})
+    return pd.DataFrame(cols)
+
+def sweep_scenarios(sweeps):
+    # every combination of evenly spaced growth rates, from
+    # ['staff_costs=0:0.1:11', ...] (input=start:stop:number)
+    grids = {}
+    for sweep in sweeps:
+        try:
+            name, spec = sweep.split('=')
+            start, stop, num = spec.split(':')
+            grids[name] = np.linspace(float(start), float(stop), int(num))
+        except ValueError:
+            raise ValueError(f"<{sweep}> is not a sweep of the form input=start:stop:number")
+        if int(num) < 1:
+            raise ValueError(f"<{sweep}> sweeps no growth rates")
+    combos = list(itertools.product(*grids.values()))
+    names = [', '.join(f"{k}={v:g}" for k, v in zip(grids, combo)) for combo in combos]
+    return pd.DataFrame(combos, columns=list(grids), index=pd.Index(names, name='scenario'))
+
+def load_scenarios(scenario_file):
+    # JSON of {scenario name: {input: annual growth rate, ...}, ...}, where a
+    # scenario of {} keeps every input flat
+    rates = json.load(scenario_file)
+    scenarios = pd.DataFrame(list(rates.values()), index=list(rates))
+    return scenarios.fillna(0.0).rename_axis('scenario')
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-i', '--input-csv', type=pathlib.Path, default=pathlib.Path('wide.csv'),
+        help="The wide table from merge_data (CSV, Parquet or Feather)")
+    parser.add_argument('-s', '--scenarios', type=argparse.FileType('r'),
+        help="JSON of scenarios: {name: {input: annual growth rate}}")
+    parser.add_argument('--sweep', nargs='+', default=[],
+        help="Grid of growth rates to sweep, as input=start:stop:number")
+    parser.add_argument('-y', '--base-year',
+        help="Academic year projected from (the latest by default)")
+    parser.add_argument('-n', '--horizon', type=int, default=5,
+        help="Number of years projected")
+    parser.add_argument('-k', '--kfi', type=lambda s: s.split(','),
+        help="Comma separated KFIs to project (all by default)")
+    parser.add_argument('-o', '--output', default='projection',
+        help="Name of the output table")
+    parser.add_argument('-f', '--output-format', choices=['csv', 'parquet', 'feather'],
+        default='csv', help="File format of the output table")
+    args = parser.parse_args()
+
+    if not (args.scenarios or args.sweep):
+        sys.exit("Give the scenarios to project as a JSON file and/or a --sweep.")
+    scenarios = []
+    if args.scenarios:
+        scenarios.append(load_scenarios(args.scenarios))
+    if args.sweep:
+        try:
+            scenarios.append(sweep_scenarios(args.sweep))
+        except ValueError as err:
+            sys.exit(str(err))
+    scenarios = pd.concat(scenarios).fillna(0.0)
+
+    wide = read_table(args.input_csv)
+    try:
+        providers, base, year = base_inputs(wide, args.base_year)
+    except ValueError as err:
+        sys.exit(str(err))
+    years = future_years(year, args.horizon)
+    print(f"Projecting {len(providers)} providers from {year} over {len(scenarios)} scenarios")
+
+    try:
+        results = project(base, scenarios, args.horizon, args.kfi)
+    except ValueError as err:
+        sys.exit(str(err))
+    tbl = projection_table(results, providers, scenarios, years)
+    write_table(tbl.round(3), args.output, args.output_format, index=False)
+    return tbl
+
+if __name__ == "__main__":
+    main()
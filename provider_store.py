@@ -0,0 +1,135 @@
+#!/usr/bin/python3
+
+import pandas as pd
+import numpy as np
+import argparse
+import json
+import os
+import pathlib
+import shutil
+import sys
+import time
+
+# bump whenever the layout of the store changes
+STORE_VERSION = 2
+
+# file in the store directory naming the sub-directory of the current version
+CURRENT = 'CURRENT'
+
+def write_store(tbl, store_dir):
+    # the table sorted by provider (and year), a .npy file per column and an
+    # index from ukprn to its range of rows. Text columns are kept as integer
+    # codes, with their categories in meta.json.
+    #
+    # Each write goes to a new sub-directory, which CURRENT is then switched
+    # to. Files are never rewritten in place, so readers that have an older
+    # version mapped keep their own (unlinked) files.
+    store_dir = pathlib.Path(store_dir)
+    store_dir.mkdir(parents=True, exist_ok=True)
+    version = f"v-{time.time_ns()}-{os.getpid()}"
+    version_dir = store_dir.joinpath(version)
+    version_dir.mkdir()
+
+    tbl = tbl.assign(ukprn=tbl['ukprn'].astype('int64'))
+    tbl = tbl.sort_values(['ukprn', 'academic year'], kind='stable').reset_index(drop=True)
+
+    columns = {}
+    for i, col in enumerate(tbl.columns):
+        fname = f"col-{i}.npy"
+        if pd.api.types.is_numeric_dtype(tbl[col]):
+            np.save(version_dir.joinpath(fname), tbl[col].to_numpy())
+            columns[col] = {'file': fname}
+        else:
+            codes, categories = pd.factorize(tbl[col], sort=True)
+            np.save(version_dir.joinpath(fname), codes.astype('int32'))
+            columns[col] = {'file': fname, 'categories': [str(c) for c in categories]}
+
+    # [ukprn, first row, row after the last] of each provider
+    ukprns, starts, counts = np.unique(tbl['ukprn'].to_numpy(), return_index=True, return_counts=True)
+    np.save(version_dir.joinpath('index.npy'), np.column_stack([ukprns, starts, starts + counts]))
+    meta = {'version': STORE_VERSION, 'rows': len(tbl), 'columns': columns}
+    version_dir.joinpath('meta.json').write_text(json.dumps(meta, indent=1))
+
+    # switched to last, so a version is only ever opened once complete
+    tmp_file = store_dir.joinpath(f"{CURRENT}.{os.getpid()}.tmp")
+    tmp_file.write_text(version)
+    os.replace(tmp_file, store_dir.joinpath(CURRENT))
+
+    # earlier versions, and the files of the flat version 1 layout
+    for path in store_dir.iterdir():
+        if path.is_dir() and path.name.startswith('v-') and path.name != version:
+            shutil.rmtree(path, ignore_errors=True)
+        elif path.name == 'index.npy' or path.name == 'meta.json' or path.match('col-*.npy'):
+            path.unlink()
+
+def open_store(store_dir):
+    # memory maps of every column of the current version, nothing is read
+    # until it is sliced
+    store_dir = pathlib.Path(store_dir)
+    if not store_dir.joinpath(CURRENT).exists():
+        raise ValueError(f"<{store_dir}> is not a provider store (of version {STORE_VERSION})")
+    while True:
+        version = store_dir.joinpath(CURRENT).read_text().strip()
+        try:
+            return open_version(store_dir, version)
+        except FileNotFoundError:
+            # replaced (and removed) by a write since CURRENT was read
+            if store_dir.joinpath(CURRENT).read_text().strip() == version:
+                raise
+
+def open_version(store_dir, version):
+    version_dir = store_dir.joinpath(version)
+    meta = json.loads(version_dir.joinpath('meta.json').read_text())
+    if meta['version'] != STORE_VERSION:
+        raise ValueError(f"The store <{store_dir}> is version {meta['version']}, not {STORE_VERSION}")
+    index = np.load(version_dir.joinpath('index.npy'))
+    return {
+        'meta': meta,
+        'index': {int(u): (int(start), int(stop)) for u, start, stop in index},
+        'columns': {
+            col: np.load(version_dir.joinpath(info['file']), mmap_mode='r')
+            for col, info in meta['columns'].items()
+        },
+    }
+
+def provider_slice(store, ukprn, columns=None):
+    # zero-copy views of one provider's rows (category codes for text columns)
+    start, stop = store['index'][ukprn]
+    if columns is None:
+        columns = list(store['columns'])
+    return {col: store['columns'][col][start:stop] for col in columns}
+
+def provider_frame(store, ukprn, columns=None):
+    # one provider's history as a DataFrame, with text columns decoded
+    rows = provider_slice(store, ukprn, columns)
+    decoded = {}
+    for col, values in rows.items():
+        categories = store['meta']['columns'][col].get('categories')
+        if categories is None:
+            decoded[col] = np.array(values)
+        else:
+            # missing values have the code -1
+            decoded[col] = np.append(np.asarray(categories, dtype=object), None)[values]
+    return pd.DataFrame(decoded)
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-s', '--store', type=pathlib.Path, default=pathlib.Path('kfi_store'),
+        help="Directory of the provider store written by merge_data")
+    parser.add_argument('-u', '--ukprn', type=int, nargs='+', required=True,
+        help="UK Provider Numbers whose history is printed")
+    parser.add_argument('-c', '--columns', type=lambda s: s.split(','),
+        help="Comma separated columns to print (all by default)")
+    args = parser.parse_args()
+
+    try:
+        store = open_store(args.store)
+    except ValueError as err:
+        sys.exit(str(err))
+    for ukprn in args.ukprn:
+        if ukprn not in store['index']:
+            sys.exit(f"{ukprn} is not a valid UK Provider Number.")
+        print(provider_frame(store, ukprn, args.columns).to_string(index=False))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,160 @@
+#!/usr/bin/python3
+
+import pandas as pd
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor
+import argparse
+import json
+import pathlib
+import sys
+
+from merge_data import KFI_INPUTS, kfi_engine, kfi_plan, read_table, write_table
+from projection import PROJECTION_LINKS, apply_links, base_inputs
+
+# the lines shocked in each draw, with the standard deviation of the relative
+# shock to each and the correlation between them
+SHOCKS = ['he_fees', 'fbg', 'research', 'staff_costs', 'pension_provisions']
+SHOCK_VOLS = [0.10, 0.08, 0.12, 0.04, 0.50]
+SHOCK_CORR = [
+    [1.0, 0.3, 0.2, 0.0, 0.0],
+    [0.3, 1.0, 0.4, 0.0, 0.0],
+    [0.2, 0.4, 1.0, 0.0, 0.0],
+    [0.0, 0.0, 0.0, 1.0, 0.5],
+    [0.0, 0.0, 0.0, 0.5, 1.0],
+]
+
+# a shocked year's change in surplus goes through staff costs and the income
+# and expenditure totals, and then comes out of unrestricted reserves. Pension
+# provision movements are non-cash (as the KFIs' pension_adjust has it), so cash
+# and current assets only move by the change in surplus without them.
+STRESS_LINKS = {
+    'staff_costs': 'staff_costs + delta_pension_provisions',
+    **PROJECTION_LINKS,
+    'ops_cash': 'ops_cash + delta_surplus + delta_pension_provisions',
+    'cash': 'cash + delta_surplus + delta_pension_provisions',
+    'current_assets': 'current_assets + delta_surplus + delta_pension_provisions',
+    'unrestricted_reserve': 'unrestricted_reserve + delta_surplus',
+}
+
+# the lower bounds drawn on the plots, a draw below one is a breach
+THRESHOLDS = {
+    'net_liquidity_days': 60,
+    'unrestricted_vs_income': 0.5,
+    'current_assets_vs_liability': 1.0,
+    'ops_cash_vs_income': 0.05,
+}
+
+def shock_factors(rng, draws, providers, vols, chol):
+    # (draws x providers x shocks) multipliers of correlated normal shocks
+    z = rng.standard_normal((draws, providers, len(vols))) @ chol.T
+    return 1 + z * np.asarray(vols)
+
+def stress_batch(base, seed, draws, shocks=SHOCKS, vols=SHOCK_VOLS, corr=SHOCK_CORR):
+    # breach counts of each provider over one batch of draws, seeded by its
+    # own SeedSequence so the totals don't depend on how batches are spread
+    rng = np.random.default_rng(seed)
+    providers = len(base[shocks[0]])
+    factors = shock_factors(rng, draws, providers, vols, np.linalg.cholesky(corr))
+
+    flat = {name: array[None, :] for name, array in base.items()}
+    env = dict(flat)
+    for k, name in enumerate(shocks):
+        env[name] = flat[name] * factors[..., k]
+    for name in base:
+        env[f"delta_{name}"] = env[name] - flat[name]
+    apply_links(env, flat, STRESS_LINKS)
+
+    indicators = list(THRESHOLDS)
+    inputs, _ = kfi_plan(indicators)
+    kfis = kfi_engine({name: env[name] for name in inputs}, indicators)
+
+    counts = {}
+    any_breach = np.zeros((draws, providers), dtype=bool)
+    for name, threshold in THRESHOLDS.items():
+        kfi = np.broadcast_to(kfis[name], (draws, providers))
+        breach = kfi < threshold
+        any_breach |= breach
+        counts[name] = breach.sum(axis=0)
+        counts[f"{name} draws"] = np.isfinite(kfi).sum(axis=0)
+    counts['any'] = any_breach.sum(axis=0)
+    return counts
+
+def stress_test(base, draws=100_000, batch_size=2_000, seed=0, jobs=1, **shock_params):
+    # probability of each provider breaching each threshold (and any of them)
+    # over the given number of draws, made in batches across processes
+    sizes = [batch_size] * (draws // batch_size)
+    if draws % batch_size:
+        sizes.append(draws % batch_size)
+    seeds = np.random.SeedSequence(seed).spawn(len(sizes))
+
+    if jobs > 1:
+        with ProcessPoolExecutor(max_workers=jobs) as pool:
+            futures = [pool.submit(stress_batch, base, s, n, **shock_params) for s, n in zip(seeds, sizes)]
+            batches = [f.result() for f in futures]
+    else:
+        batches = [stress_batch(base, s, n, **shock_params) for s, n in zip(seeds, sizes)]
+
+    totals = {key: sum(b[key] for b in batches) for key in batches[0]}
+    with np.errstate(invalid='ignore', divide='ignore'):
+        probs = {
+            f"p_{name}": np.where(totals[f"{name} draws"] > 0,
+                totals[name] / totals[f"{name} draws"], np.nan)
+            for name in THRESHOLDS
+        }
+    probs['p_any'] = totals['any'] / draws
+    return probs
+
+def load_shocks(shock_file):
+    # JSON of {"shocks": [...], "vols": [...], "corr": [[...], ...]}
+    params = json.load(shock_file)
+    params = {'shocks': params.get('shocks', SHOCKS), 'vols': params.get('vols', SHOCK_VOLS),
+        'corr': params.get('corr', SHOCK_CORR)}
+    unknown = [name for name in params['shocks'] if name not in KFI_INPUTS]
+    if unknown:
+        sys.exit(f"Unknown inputs: {', '.join(unknown)}")
+    if not len(params['shocks']) == len(params['vols']) == len(params['corr']):
+        sys.exit("Give a volatility and a row of correlations for every shock.")
+    try:
+        np.linalg.cholesky(params['corr'])
+    except np.linalg.LinAlgError:
+        sys.exit("The shock correlations must be positive definite.")
+    return params
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-i', '--input-csv', type=pathlib.Path, default=pathlib.Path('wide.csv'),
+        help="The wide table from merge_data (CSV, Parquet or Feather)")
+    parser.add_argument('-y', '--base-year',
+        help="Academic year that is stressed (the latest by default)")
+    parser.add_argument('-n', '--draws', type=int, default=100_000,
+        help="Number of draws per provider")
+    parser.add_argument('-b', '--batch-size', type=int, default=2_000,
+        help="Number of draws sampled at once")
+    parser.add_argument('-s', '--seed', type=int, default=0)
+    parser.add_argument('-j', '--jobs', type=int, default=1,
+        help="Number of processes the batches are spread across")
+    parser.add_argument('--shocks', type=argparse.FileType('r'),
+        help="JSON of the shocked lines, their volatilities and correlations")
+    parser.add_argument('-o', '--output', default='stress',
+        help="Name of the output table")
+    parser.add_argument('-f', '--output-format', choices=['csv', 'parquet', 'feather'],
+        default='csv', help="File format of the output table")
+    args = parser.parse_args()
+
+    if args.draws < 1 or args.batch_size < 1:
+        sys.exit("The number of draws and the batch size must be at least 1.")
+    shock_params = load_shocks(args.shocks) if args.shocks else {}
+    wide = read_table(args.input_csv)
+    try:
+        providers, base, year = base_inputs(wide, args.base_year)
+    except ValueError as err:
+        sys.exit(str(err))
+    print(f"Stressing {len(providers)} providers in {year} with {args.draws} draws each")
+
+    probs = stress_test(base, args.draws, args.batch_size, args.seed, args.jobs, **shock_params)
+    tbl = pd.concat([providers.assign(**{'academic year': year}), pd.DataFrame(probs)], axis=1)
+    write_table(tbl.round(4), args.output, args.output_format, index=False)
+    return tbl
+
+if __name__ == "__main__":
+    main()
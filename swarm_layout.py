@@ -0,0 +1,101 @@
+import hashlib
+import json
+import os
+import numpy as np
+import pandas as pd
+
+def levels(col):
+    # category order as seaborn would use it: the categories of a categorical,
+    # otherwise the order of appearance
+    if isinstance(col.dtype, pd.CategoricalDtype):
+        return list(col.cat.categories)
+    return list(col.dropna().unique())
+
+def beeswarm(y, diameter):
+    # sorted sweep: points are placed from the bottom up, each at the offset
+    # closest to the centre that clears every placed point less than one
+    # diameter below it
+    order = np.argsort(y, kind='stable')
+    ys = y[order]
+    xs = np.zeros(len(ys))
+
+    lo = 0
+    for i in range(1, len(ys)):
+        while ys[i] - ys[lo] >= diameter:
+            lo += 1
+        if lo == i:
+            continue
+        near_x = xs[lo:i]
+        near_dy = ys[i] - ys[lo:i]
+
+        # candidates are the centre or touching either side of a neighbour
+        dx = np.sqrt(diameter**2 - near_dy**2)
+        cands = np.concatenate([[0], near_x - dx, near_x + dx])
+        cands = cands[np.argsort(np.abs(cands), kind='stable')]
+        clear = ((cands[:, None] - near_x)**2 + near_dy**2 >= diameter**2 * (1 - 1e-9)).all(axis=1)
+        xs[i] = cands[np.argmax(clear)]
+
+    offsets = np.empty_like(xs)
+    offsets[order] = xs
+    return offsets
+
+def swarm_sector(tbl, hue):
+    # the years and groups the swarms are split by, with each row's codes,
+    # shared by every metric plotted from the same table
+    years = levels(tbl['academic year'])
+    groups = levels(tbl[hue])
+    return {
+        'years': years,
+        'groups': groups,
+        'x': pd.Categorical(tbl['academic year'], categories=years).codes.astype('int64'),
+        'hue': pd.Categorical(tbl[hue], categories=groups).codes.astype('int64'),
+    }
+
+def swarm_positions(values, sector, ylim, axes_pt, diameter=5, width=0.8):
+    # x positions (in category units) of every row of a dodged swarm, with one
+    # swarm per (year, group) laid out in points on an axes of the given size
+    n_groups = len(sector['groups'])
+    swarm = sector['x'] * n_groups + sector['hue']
+
+    # scales between data units and points
+    y_scale = axes_pt[1] / (ylim[1] - ylim[0])
+    x_scale = len(sector['years']) / axes_pt[0]
+    dodge = width / n_groups
+
+    pos = np.full(len(values), np.nan)
+    placed = np.isfinite(values) & (sector['x'] >= 0) & (sector['hue'] >= 0)
+    for key in np.unique(swarm[placed]):
+        rows = np.flatnonzero(placed & (swarm == key))
+        x, j = divmod(key, n_groups)
+        centre = x - width/2 + dodge*(j + 0.5)
+        # points which don't fit in the swarm's width are kept at its edge
+        offsets = beeswarm(values[rows] * y_scale, diameter) * x_scale
+        pos[rows] = centre + np.clip(offsets, -dodge/2, dodge/2)
+
+    return pos
+
+def swarm_key(values, sector, ylim, axes_pt, diameter=5, width=0.8):
+    # hash of the plotted data and everything the layout depends on
+    digest = hashlib.sha256()
+    for arr in [values, sector['x'], sector['hue']]:
+        digest.update(np.ascontiguousarray(arr).tobytes())
+    params = {'years': sector['years'], 'groups': sector['groups'], 'ylim': list(ylim),
+        'axes': [round(a, 3) for a in axes_pt], 'diameter': diameter, 'width': width}
+    digest.update(json.dumps(params, sort_keys=True, default=str).encode())
+    return digest.hexdigest()
+
+def cached_swarm_positions(values, sector, ylim, axes_pt, cache_dir=None, name='swarm', **kwargs):
+    if cache_dir is None:
+        return swarm_positions(values, sector, ylim, axes_pt, **kwargs)
+
+    cache_file = cache_dir.joinpath(f"{name}-{swarm_key(values, sector, ylim, axes_pt, **kwargs)}.npy")
+    if cache_file.exists():
+        return np.load(cache_file)
+    pos = swarm_positions(values, sector, ylim, axes_pt, **kwargs)
+    cache_dir.mkdir(parents=True, exist_ok=True)
+    # write then rename, so a run sharing the cache never loads a half written file
+    tmp_file = cache_file.with_suffix(f".{os.getpid()}.tmp")
+    with open(tmp_file, 'wb') as f:
+        np.save(f, pos)
+    os.replace(tmp_file, cache_file)
+    return pos